@@ -0,0 +1,272 @@
+import numpy as np
+import polars as pl
+
+__all__ = ["BatchGraph"]
+
+class BatchGraph:
+    """
+    Memory-resident batch link graph in compressed sparse row (CSR) form.
+
+    Batch IDs are mapped to dense integers once at load time. Each direction keeps an
+    `indptr` offset array over the source batches, the destination batch of every link
+    (-1 when the link leads to a raw material with no producing batch) and the link rows
+    themselves, sorted by source batch so that row i of the frame is link i of the CSR.
+    A reverse index (`rev_indptr`, `rev_links`) lists the links arriving at each batch.
+
+    'Gen' links run ProductBatchID -> IngredientBatchID (from vw_Gen_PIBID), 'Trc' links
+    run IngredientBatchID -> ProductBatchID (from vw_trc_PIBID).
+    """
+
+    def __init__(self, batch_ids: pl.Series, directions: dict):
+        self.batch_ids = batch_ids
+        self.directions = directions
+        self.version = None
+
+    @classmethod
+    def load(cls, con):
+        """
+        Read the Gen and Trc batch links from the database and build both CSR directions.
+        """
+        gen = con.execute(
+            """
+            select ProductBatchID, IngredientBatchID
+            from vw_Gen_PIBID
+            group by all
+            """
+        ).pl()
+        trc = con.execute(
+            """
+            select ProductBatchID, IngredientBatchID, ItemCode, Lot_Number
+            from vw_trc_PIBID
+            where IngredientBatchID is not null
+            """
+        ).pl()
+
+        batch_ids = (
+            pl.concat([
+                gen["ProductBatchID"],
+                gen["IngredientBatchID"],
+                trc["ProductBatchID"],
+                trc["IngredientBatchID"],
+            ])
+            .drop_nulls()
+            .unique()
+            .sort()
+        )
+        graph = cls(batch_ids, {})
+        graph.directions["Gen"] = graph._csr(gen, "ProductBatchID", "IngredientBatchID")
+        graph.directions["Trc"] = graph._csr(trc, "IngredientBatchID", "ProductBatchID")
+        return graph
+
+    def node_ids(self, batches) -> np.ndarray:
+        """
+        Map batch IDs to dense node ids; batches not in the graph map to -1.
+        """
+        batches = pl.Series(batches).cast(self.batch_ids.dtype)
+        return (
+            batches.replace_strict(
+                self.batch_ids,
+                np.arange(len(self.batch_ids), dtype=np.int64),
+                default=-1,
+                return_dtype=pl.Int64,
+            )
+            .fill_null(-1)
+            .to_numpy()
+        )
+
+    def _csr(self, links: pl.DataFrame, src_col: str, dst_col: str) -> dict:
+        src = self.node_ids(links[src_col])
+        order = np.argsort(src, kind="stable")
+        src = src[order]
+        counts = np.bincount(src, minlength=len(self.batch_ids))
+        indptr = np.zeros(len(self.batch_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        links = links[order]
+        dst = self.node_ids(links[dst_col])
+
+        rev_links = np.argsort(dst, kind="stable")
+        rev_links = rev_links[dst[rev_links] >= 0]
+        rev_counts = np.bincount(dst[rev_links], minlength=len(self.batch_ids))
+        rev_indptr = np.zeros(len(self.batch_ids) + 1, dtype=np.int64)
+        np.cumsum(rev_counts, out=rev_indptr[1:])
+        return {
+            "indptr": indptr,
+            "src": src,
+            "dst": dst,
+            "rev_indptr": rev_indptr,
+            "rev_links": rev_links,
+            "links": links,
+        }
+
+    def walk(self, direction: str, roots, max_level: int, first_level: int) -> pl.DataFrame:
+        """
+        Breadth-first walk from every root batch, one whole frontier at a time.
+
+        Every batch is expanded once per root, at the lowest level it is reached, so the work
+        is linear in the number of reachable (root, batch) pairs. Links leaving a batch found
+        k steps from its root are reported at level k + first_level, up to max_level.
+
+        Returns:
+            pl.DataFrame: The link rows walked, plus RootBatchID and Level.
+        """
+        csr = self.directions[direction]
+        indptr, dst = csr["indptr"], csr["dst"]
+        n = len(self.batch_ids)
+
+        root_nodes = np.unique(self.node_ids(roots))
+        root_nodes = root_nodes[root_nodes >= 0]
+        frontier_root, frontier_node = root_nodes, root_nodes
+        visited = root_nodes * n + root_nodes
+
+        walked_links, walked_roots, walked_levels = [], [], []
+        level = first_level
+        while len(frontier_node) and level <= max_level:
+            links, link_roots = expand(indptr, frontier_node, frontier_root)
+            if len(links) == 0:
+                break
+            walked_links.append(links)
+            walked_roots.append(link_roots)
+            walked_levels.append(np.full(len(links), level, dtype=np.int32))
+
+            reached = dst[links]
+            keep = reached >= 0
+            keys = np.unique(link_roots[keep] * n + reached[keep])
+            keys = keys[~np.isin(keys, visited, assume_unique=True)]
+            visited = np.union1d(visited, keys)
+            frontier_root, frontier_node = keys // n, keys % n
+            level += 1
+
+        return self._walked(csr, walked_links, walked_roots, walked_levels)
+
+    def link(
+        self,
+        direction: str,
+        roots,
+        targets,
+        max_level: int,
+        first_level: int,
+        include_target_links: bool = False,
+    ) -> pl.DataFrame:
+        """
+        Links on every path from each root batch to a target batch within the level limit.
+
+        A link is on a connecting path of a root when the root reaches its source batch and its
+        destination batch reaches a target, in at most the hops the level limit leaves. This is
+        the part of walk() that leads to a target, reported with the same levels.
+
+        The distances are found by searching from both ends at once: a forward search per root
+        and one backward search from all targets, always growing whichever frontier is smaller,
+        until their radii add up to the hop limit. Each search is then completed only through
+        batches the other one has already shown to lie on a path, so the cone below a widely
+        used lot is never expanded in full.
+
+        With include_target_links the links leaving each target reached are reported too.
+
+        Returns:
+            pl.DataFrame: The path link rows, plus RootBatchID and Level.
+        """
+        csr = self.directions[direction]
+        n = len(self.batch_ids)
+        max_hops = max_level - first_level + (0 if include_target_links else 1)
+
+        root_nodes = np.unique(self.node_ids(roots))
+        root_nodes = root_nodes[root_nodes >= 0]
+        target_nodes = np.unique(self.node_ids(targets))
+        target_nodes = target_nodes[target_nodes >= 0]
+
+        # forward distance per (root, batch) key, sorted on key; backward distance per batch
+        fwd_keys = root_nodes * n + root_nodes
+        fwd_dist = np.zeros(len(fwd_keys), dtype=np.int64)
+        frontier_keys = fwd_keys
+        bwd_dist = np.full(n, -1, dtype=np.int64)
+        bwd_dist[target_nodes] = 0
+        bwd_frontier = target_nodes
+        fwd_radius, bwd_radius = 0, 0
+
+        def forward(keys):
+            nonlocal fwd_keys, fwd_dist
+            links, link_roots = expand(csr["indptr"], keys % n, keys // n)
+            reached = csr["dst"][links]
+            keep = reached >= 0
+            keys = np.unique(link_roots[keep] * n + reached[keep])
+            keys = keys[~np.isin(keys, fwd_keys)]
+            order = np.argsort(np.concatenate([fwd_keys, keys]), kind="stable")
+            fwd_keys = np.concatenate([fwd_keys, keys])[order]
+            fwd_dist = np.concatenate([fwd_dist, np.full(len(keys), fwd_radius + 1)])[order]
+            return keys
+
+        def backward(nodes):
+            links, _ = expand(csr["rev_indptr"], nodes, nodes)
+            reached = np.unique(csr["src"][csr["rev_links"][links]])
+            return reached[bwd_dist[reached] < 0]
+
+        # every batch within fwd_radius of a root and within bwd_radius of a target
+        while fwd_radius + bwd_radius < max_hops and len(frontier_keys) and len(bwd_frontier):
+            if len(bwd_frontier) < len(frontier_keys):
+                bwd_frontier = backward(bwd_frontier)
+                bwd_radius += 1
+                bwd_dist[bwd_frontier] = bwd_radius
+            else:
+                frontier_keys = forward(frontier_keys)
+                fwd_radius += 1
+
+        # A path batch further than fwd_radius from its root is within bwd_radius of a target,
+        # so the forward search only continues through batches with a known backward distance
+        # that still fits the hop limit.
+        while len(frontier_keys) and fwd_radius < max_hops:
+            nodes = frontier_keys % n
+            frontier_keys = frontier_keys[(bwd_dist[nodes] >= 0) & (fwd_radius + bwd_dist[nodes] <= max_hops)]
+            if len(frontier_keys) == 0:
+                break
+            frontier_keys = forward(frontier_keys)
+            fwd_radius += 1
+
+        # Likewise a path batch further than bwd_radius from the targets is within fwd_radius
+        # of a root, so the backward search only continues through batches a root reaches.
+        fwd_min = np.full(n, max_hops + 1, dtype=np.int64)
+        np.minimum.at(fwd_min, fwd_keys % n, fwd_dist)
+        while len(bwd_frontier) and bwd_radius < max_hops:
+            bwd_frontier = bwd_frontier[fwd_min[bwd_frontier] + bwd_radius <= max_hops]
+            if len(bwd_frontier) == 0:
+                break
+            bwd_frontier = backward(bwd_frontier)
+            bwd_radius += 1
+            bwd_frontier = bwd_frontier[fwd_min[bwd_frontier] + bwd_radius <= max_hops]
+            bwd_dist[bwd_frontier] = bwd_radius
+
+        # links from a batch a root reaches to one that reaches a target, within the hop limit
+        nodes = fwd_keys % n
+        on_path = (bwd_dist[nodes] >= 0) & (fwd_dist + bwd_dist[nodes] <= max_hops)
+        path_roots, path_nodes, path_pos = fwd_keys[on_path] // n, nodes[on_path], fwd_dist[on_path]
+        links, link_roots = expand(csr["indptr"], path_nodes, path_roots)
+        pos = np.repeat(path_pos, np.diff(csr["indptr"])[path_nodes])
+        reached = csr["dst"][links]
+        remaining = np.where(reached >= 0, bwd_dist[np.maximum(reached, 0)], -1)
+        keep = (remaining >= 0) & (pos + 1 + remaining <= max_hops)
+        if include_target_links:
+            keep |= bwd_dist[csr["src"][links]] == 0
+        return self._walked(
+            csr,
+            [links[keep]],
+            [link_roots[keep]],
+            [(pos[keep] + first_level).astype(np.int32)],
+        )
+
+    def _walked(self, csr, walked_links, walked_roots, walked_levels) -> pl.DataFrame:
+        links = np.concatenate(walked_links) if walked_links else np.zeros(0, dtype=np.int64)
+        roots = np.concatenate(walked_roots) if walked_roots else np.zeros(0, dtype=np.int64)
+        levels = np.concatenate(walked_levels) if walked_levels else np.zeros(0, dtype=np.int32)
+        return csr["links"][links].with_columns(
+            self.batch_ids.gather(roots).alias("RootBatchID"),
+            pl.Series("Level", levels, dtype=pl.Int32),
+        )
+
+def expand(indptr, nodes, owners):
+    """
+    All CSR entries of `nodes`, with the owner (root) of each node repeated alongside.
+    """
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    total = int(counts.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets, np.repeat(owners, counts)
@@ -0,0 +1,238 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from SyntheticLineage import SIZES, generate
+
+# Column lists app2 asks get_lineage for, grouped on parent lots or on individual bags
+PARENT_LOT_COLUMNS = """type, root_parentlot, root_itemcode, product_parentlot as startnode,
+    product_itemcode, ingredient_parentlot as endnode, ingredient_itemcode, level as Level,
+    root_unit_op_name as ParentName, product_unit_op_name as ProductName,
+    ingredient_unit_op_name as IngredientName,
+    root_description as ParentDescription, product_description as ProductDescription,
+    ingredient_description as IngredientDescription,
+    COUNT(*) as CntRecs"""
+BAG_COLUMNS = """type, root_parentlot, root_itemcode, product_lot as startnode,
+    product_itemcode, ingredient_lot as endnode, ingredient_itemcode, level as Level,
+    root_unit_op_name as ParentName, product_unit_op_name as ProductName,
+    ingredient_unit_op_name as IngredientName,
+    root_description as ParentDescription, product_description as ProductDescription,
+    ingredient_description as IngredientDescription,
+    COUNT(*) as CntRecs"""
+
+ITEM_SEARCH_TERMS = ("", "I0001", "L0000", "-01", "R00001")
+PRODUCT_SEARCH_TERMS = ("", "P0", "001")
+
+def timed(fn, repeat):
+    """
+    Run `fn` once cold and `repeat` times warm, and summarize the wall-clock seconds.
+    """
+    start = time.perf_counter()
+    result = fn()
+    first = time.perf_counter() - start
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return result, {
+        "first": first,
+        "min": min(seconds, default=first),
+        "median": statistics.median(seconds) if seconds else first,
+        "max": max(seconds, default=first),
+    }
+
+def sample_nodes(con):
+    """
+    Start and target lots for the trace cases, picked deterministically from the database.
+
+    The genealogy start is the parent lot of the middle production batch, the traceability start
+    a raw material parent lot consumed by the first layer, and the link target an ingredient
+    lot a few levels below the genealogy start.
+    """
+    mid_lot, mid_parent = con.execute(
+        """
+        select LOT_NUMBER, parent_lot_number from vw_MatTxnsWithItemCodes
+        where TYPE = 'Product'
+        order by abs(BATCH_ID - (select max(BATCH_ID) / 2 from vw_MatTxnsWithItemCodes)), LOT_NUMBER
+        limit 1
+        """
+    ).fetchone()
+    raw_lot, raw_parent = con.execute(
+        """
+        select LOT_NUMBER, parent_lot_number from vw_MatTxnsWithItemCodes
+        where TYPE = 'Ingredient' AND SUPPLIER_LOT_NUMBER is not null
+        order by BATCH_ID, LOT_NUMBER
+        limit 1
+        """
+    ).fetchone()
+    return {
+        "gen": {"parent_lot": mid_parent, "bag": mid_lot},
+        "trc": {"parent_lot": raw_parent, "bag": raw_lot},
+    }
+
+def measure(repeat=5, engines=("sql",)):
+    """
+    Time get_lineage and the autocomplete lookups against the database Lineage is configured
+    with, and return one record per case.
+    """
+    import polars as pl
+
+    import Lineage
+
+    records = []
+    nodes = sample_nodes(Lineage.connection)
+
+    for name, build in (("item_index", Lineage.get_item_index), ("product_index", Lineage.get_product_index)):
+        start = time.perf_counter()
+        index = build()
+        records.append({"case": "index_build", "index": name, "rows": len(index),
+                        "first": time.perf_counter() - start})
+    for term in ITEM_SEARCH_TERMS:
+        result, stats = timed(lambda: Lineage.get_item_codes(term), repeat)
+        records.append({"case": "get_item_codes", "term": term, "rows": len(result), **stats})
+    for term in PRODUCT_SEARCH_TERMS:
+        result, stats = timed(lambda: Lineage.get_product_codes(term), repeat)
+        records.append({"case": "get_product_codes", "term": term, "rows": len(result), **stats})
+
+    for scope, outputcols in (("parent_lot", PARENT_LOT_COLUMNS), ("bag", BAG_COLUMNS)):
+        for direction in ("gen", "trc", "all"):
+            start_node = nodes["trc" if direction == "trc" else "gen"][scope]
+            for engine in engines:
+                result, stats = timed(
+                    lambda: Lineage.get_lineage(
+                        [start_node], GenOrTrc=direction, outputcols=outputcols, engine=engine, use_cache=False
+                    ),
+                    repeat,
+                )
+                records.append({"case": "get_lineage", "direction": direction, "scope": scope,
+                                "engine": engine, "start": start_node, "rows": len(result), **stats})
+
+        # link the genealogy start to the deepest ingredient its genealogy reaches
+        start_node = nodes["gen"][scope]
+        gen = Lineage.get_lineage([start_node], GenOrTrc="gen", use_cache=False)
+        if len(gen) == 0:
+            continue
+        target = gen.sort(["Level", "ingredient_lot"], descending=[True, False]).select(
+            pl.col("ingredient_ParentLot" if scope == "parent_lot" else "ingredient_lot")
+        ).item(0, 0)
+        result, stats = timed(
+            lambda: Lineage.get_lineage(
+                [start_node], [target], GenOrTrc="all", outputcols=outputcols, engine="link", use_cache=False
+            ),
+            repeat,
+        )
+        records.append({"case": "get_lineage", "direction": "link", "scope": scope, "engine": "link",
+                        "start": start_node, "target": target, "rows": len(result), **stats})
+    return records
+
+def run(sizes, workdir, repeat=5, engines=("sql",), refresh=True):
+    """
+    Generate a database per size and measure each one in a fresh interpreter, since Lineage opens
+    its database at import.
+
+    Args:
+        sizes (list): Names of SyntheticLineage.SIZES to run.
+        workdir (str): Directory the generated databases are written to.
+        repeat (int): Warm repetitions per case.
+        engines (tuple): get_lineage engines to time the gen/trc/all cases with.
+        refresh (bool): Materialize MatTxnsWithItemCodes (and the closure for the 'closure'
+            engine) before measuring, as a deployed database would have them.
+
+    Returns:
+        dict: Run metadata and the records of every size.
+    """
+    workdir = os.path.abspath(workdir)
+    os.makedirs(workdir, exist_ok=True)
+    here = os.path.dirname(os.path.abspath(__file__))
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "sizes": {},
+    }
+    for size in sizes:
+        path = os.path.join(workdir, f"lineage_{size}.db")
+        env = dict(
+            os.environ,
+            LINEAGE_DATABASE_URL=path,
+            LINEAGE_CLOSURE_URL=os.path.join(workdir, f"lineage_{size}_closure.db"),
+        )
+        start = time.perf_counter()
+        generate(path, **SIZES[size])
+        generate_seconds = time.perf_counter() - start
+        lineage = os.path.join(here, "Lineage.py")
+        if refresh:
+            subprocess.run([sys.executable, lineage, "refresh-mat-txns"], env=env, check=True)
+            if "closure" in engines:
+                subprocess.run([sys.executable, lineage, "build-closure"], env=env, check=True)
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "measure", "--repeat", str(repeat),
+             "--engines", ",".join(engines)],
+            env=env, check=True, stdout=subprocess.PIPE, text=True,
+        )
+        report["sizes"][size] = {
+            "params": SIZES[size],
+            "generate_seconds": generate_seconds,
+            "records": json.loads(out.stdout.splitlines()[-1]),
+        }
+    return report
+
+def record_key(record):
+    return tuple(record.get(name) for name in ("case", "index", "term", "direction", "scope", "engine"))
+
+def compare(baseline, current):
+    """
+    Print the median (or first, for one-off cases) seconds of two reports side by side.
+    """
+    print(f"{'size':8} {'case':60} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for size, run in current["sizes"].items():
+        before = {record_key(r): r for r in baseline["sizes"].get(size, {}).get("records", [])}
+        for record in run["records"]:
+            old = before.get(record_key(record))
+            stat = "median" if "median" in record else "first"
+            label = " ".join(str(part) for part in record_key(record) if part is not None)
+            if old is None:
+                print(f"{size:8} {label:60} {'-':>10} {record[stat]:10.4f} {'-':>7}")
+            else:
+                ratio = record[stat] / old[stat] if old[stat] else float("inf")
+                print(f"{size:8} {label:60} {old[stat]:10.4f} {record[stat]:10.4f} {ratio:7.2f}")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark lineage traces and autocomplete on synthetic databases.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="Generate databases and time every case.")
+    run_parser.add_argument("--sizes", default="small", help=f"Comma separated, of {', '.join(SIZES)}.")
+    run_parser.add_argument("--workdir", default="bench")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--engines", default="sql", help="Comma separated get_lineage engines.")
+    run_parser.add_argument("--no-refresh", action="store_true", help="Measure on the plain views.")
+    run_parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    measure_parser = sub.add_parser("measure", help="Time every case against LINEAGE_DATABASE_URL.")
+    measure_parser.add_argument("--repeat", type=int, default=5)
+    measure_parser.add_argument("--engines", default="sql")
+    compare_parser = sub.add_parser("compare", help="Compare two JSON reports.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        report = run(args.sizes.split(","), args.workdir, args.repeat, tuple(args.engines.split(",")),
+                     not args.no_refresh)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            print(json.dumps(report, indent=2))
+    elif args.command == "measure":
+        print(json.dumps(measure(args.repeat, tuple(args.engines.split(",")))))
+    elif args.command == "compare":
+        with open(args.baseline) as f, open(args.current) as g:
+            compare(json.load(f), json.load(g))
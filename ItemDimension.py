@@ -0,0 +1,108 @@
+import numpy as np
+import polars as pl
+
+__all__ = ["ItemDimension"]
+
+class ItemDimension:
+    """
+    Memory-resident copy of ItemMaster for bulk item lookups.
+
+    Rows are sorted by ItemCode, so a batch of item codes is resolved to row positions with one
+    vectorized binary search. The low-cardinality attribute columns (ProductCode, UnitOpName,
+    Category, tag) are held dictionary-encoded as polars Categoricals and handed out in
+    ItemMaster's own types. Every ItemMaster row is kept, also when an ItemCode repeats.
+    """
+
+    categorical = ("Category", "ProductCode", "UnitOpName", "tag")
+
+    def __init__(self, frame: pl.DataFrame):
+        frame = frame.filter(pl.col("ItemCode").is_not_null()).sort("ItemCode", maintain_order=True)
+        self.schema = frame.schema
+        self.frame = frame.with_columns(
+            pl.col(col).cast(pl.Categorical) for col in self.categorical if col in frame.columns
+        )
+        self.item_codes = frame["ItemCode"].to_numpy()
+        self.version = None
+
+    @classmethod
+    def load(cls, con):
+        """
+        Read ItemMaster from the database.
+        """
+        return cls(con.execute("select * from ItemMaster").pl())
+
+    def __len__(self):
+        return len(self.item_codes)
+
+    def positions(self, item_codes) -> np.ndarray:
+        """
+        Row position of each item code, -1 for codes that are not in ItemMaster. A code with
+        several ItemMaster rows resolves to the first of them.
+        """
+        codes = pl.Series(list(item_codes), dtype=pl.String).fill_null("").to_numpy()
+        if len(self.item_codes) == 0 or len(codes) == 0:
+            return np.full(len(codes), -1, dtype=np.int64)
+        pos = np.searchsorted(self.item_codes, codes)
+        found = pos < len(self.item_codes)
+        found[found] = self.item_codes[pos[found]] == codes[found]
+        return np.where(found, pos, -1)
+
+    def matches(self, item_codes: pl.Series) -> tuple[np.ndarray, np.ndarray]:
+        """
+        LEFT JOIN of `item_codes` onto ItemMaster, as index arrays.
+
+        Returns:
+            tuple: The input position and the ItemMaster row position (-1 when there is none) of
+                every joined row, in input order. A code with several ItemMaster rows repeats its
+                input position once per row; null codes match nothing.
+        """
+        item_codes = item_codes.cast(pl.String)
+        codes = item_codes.fill_null("").to_numpy()
+        lo = np.searchsorted(self.item_codes, codes, side="left")
+        hi = np.searchsorted(self.item_codes, codes, side="right")
+        found = np.where(item_codes.is_null().to_numpy(), 0, hi - lo)
+        counts = np.maximum(found, 1)
+        rows = np.repeat(np.arange(len(codes), dtype=np.int64), counts)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        pos = np.where(np.repeat(found, counts) > 0, np.repeat(lo, counts) + offsets, -1)
+        return rows, pos
+
+    def lookup(self, positions, columns) -> pl.DataFrame:
+        """
+        The ItemMaster `columns` at row `positions`, null where the position is -1.
+        """
+        pos = pl.Series(positions, dtype=pl.Int64)
+        pos = pos.set(pos < 0, None)
+        return self.frame.select(
+            pl.col(col).gather(pos).cast(self.schema[col]) for col in columns
+        )
+
+    def enrich(self, frame: pl.DataFrame, joins) -> pl.DataFrame:
+        """
+        Join ItemMaster columns onto `frame` the way chained SQL LEFT JOINs on ItemCode would.
+
+        Args:
+            frame (pl.DataFrame): Rows to enrich.
+            joins (list): (item code column, [(ItemMaster column, output name), ...]) per join,
+                applied in order. The output columns are appended after the columns of `frame`.
+
+        Returns:
+            pl.DataFrame: The enriched rows, repeated where an item code has several ItemMaster rows.
+        """
+        for code_column, columns in joins:
+            rows, pos = self.matches(frame[code_column])
+            if len(rows) != frame.height:
+                frame = frame[rows]
+            found = self.lookup(pos, list(dict.fromkeys(source for source, _ in columns)))
+            frame = frame.hstack([found[source].alias(name) for source, name in columns])
+        return frame
+
+    def product_codes(self, item_codes) -> dict:
+        """
+        Map every known item code of `item_codes` to its ProductCode.
+        """
+        codes = pl.Series(list(item_codes), dtype=pl.String).fill_null("").to_numpy()
+        pos = self.positions(codes)
+        known = pos >= 0
+        products = self.frame["ProductCode"].cast(pl.String).to_numpy()[pos[known]]
+        return dict(zip(codes[known].tolist(), products.tolist()))
@@ -1,71 +1,601 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from contextlib import ExitStack, contextmanager
+from functools import partial
+
 import duckdb
 import polars as pl
+import pyarrow as pa
+from polars.io.plugins import register_io_source
+
+from BatchGraph import BatchGraph
+from ItemDimension import ItemDimension
+from Metrics import CACHE_REQUESTS, REQUESTS, REQUESTS_IN_FLIGHT, ROWS_RETURNED, STAGE_SECONDS
+from SearchIndex import SearchIndex
+
+DATABASE_URL = os.getenv("LINEAGE_DATABASE_URL", r"data/lineage.db")
+CLOSURE_URL = os.getenv("LINEAGE_CLOSURE_URL", r"data/lineage_closure.db")
+MAT_TXNS_TABLE = "MatTxnsWithItemCodes"
+POOL_SIZE = os.cpu_count() or 4
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+ARROW_BATCH_ROWS = 100_000
+SEARCH_LIMIT = 100
+PROFILE_STORE_SIZE = 50
+# Stages reported to get_lineage's progress callback, in order
+PROGRESS_STAGES = ("resolving nodes", "tracing Trc", "tracing Gen", "enriching")
+TRACE_POLL_SECONDS = 0.05
+
+__all__ = ["get_lineage", "get_lineage_many", "get_lineage_frontier", "get_item_codes",
+           "get_product_codes", "get_item_to_product_mapping", "build_closure", "refresh_mat_txns",
+           "get_graph", "get_item_index", "get_product_index", "get_item_dimension", "cache_info",
+           "clear_cache", "get_profile", "list_profiles", "slowest_operators", "PROGRESS_STAGES",
+           "TraceCancelled", "TraceTimeout"]
+
+class TraceCancelled(Exception):
+    """
+    Raised by get_lineage when its cancel token is set before the trace finishes.
+    """
+
+class TraceTimeout(TraceCancelled):
+    """
+    Raised by get_lineage when the trace runs past its timeout.
+    """
+
+class CursorPool:
+    """
+    Hands out DuckDB cursors on a shared read-only database, one per caller.
+
+    Every cursor is its own DuckDB connection, so the temp tables and views a trace builds
+    (tmp_TraceForLots, tmp_Trc_Results_bid, ...) are private to the request that owns the
+    cursor. Their rows are cleared when the session ends and the cursor goes back to the
+    pool for reuse. At most `size` sessions run at once; further callers wait for a free one.
+    """
+
+    def __init__(self, connection, size=POOL_SIZE):
+        self.connection = connection
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def session(self, blocking=True, guard=None):
+        """
+        Check a cursor out for the block. With blocking=False the block gets None instead of
+        waiting when every session is taken. With a TraceGuard the wait for a session ends in
+        TraceCancelled or TraceTimeout once the guard fires.
+        """
+        if guard is not None:
+            guard.acquire(self._slots)
+        elif not self._slots.acquire(blocking):
+            yield None
+            return
+        try:
+            try:
+                cursor = self._idle.get_nowait()
+            except queue.Empty:
+                cursor = self.connection.cursor()
+                create_session_views(cursor)
+            discard = False
+            try:
+                yield cursor
+            except (TraceCancelled, duckdb.InterruptException):
+                discard = True  # closing the cursor drops the abandoned trace's temp tables at once
+                raise
+            finally:
+                try:
+                    if discard:
+                        cursor.close()
+                    else:
+                        clear_session(cursor)
+                except duckdb.Error:
+                    cursor.close()
+                else:
+                    if not discard:
+                        self._idle.put(cursor)
+        finally:
+            self._slots.release()
+
+def create_session_views(con):
+    """
+    Create the session view mat_txns that the trace queries read material transactions from.
+
+    It reads the indexed table built by refresh_mat_txns() when the database has one, and
+    falls back to the vw_MatTxnsWithItemCodes view otherwise.
+    """
+    materialized = con.execute(
+        "select 1 from duckdb_tables() where table_name = ? and not temporary", [MAT_TXNS_TABLE]
+    ).fetchone()
+    source = MAT_TXNS_TABLE if materialized else "vw_MatTxnsWithItemCodes"
+    con.execute(f"CREATE TEMP VIEW IF NOT EXISTS mat_txns AS select * from {source}")
+
+def clear_session(con):
+    """
+    Empty every temp table on a cursor so the next request starts from a clean slate.
+
+    The tables themselves and the temp views stay in place, so they are only created once
+    per cursor.
+    """
+    for (name,) in con.execute(
+        "select table_name from duckdb_tables() where temporary"
+    ).fetchall():
+        con.execute(f'DELETE FROM temp."{name}"')
+
+def run_insert(con, table, query, level=None, parameters=None):
+    """
+    Fill the session temp table `table` from `query`, creating the table from the query's result
+    shape on the cursor's first use. A {level} slot in `query` is bound to `level`, and the
+    query's named $parameters to `parameters`. Returns the executed statement, whose single row
+    holds the number of rows inserted.
+
+    The INSERT is planned on every call rather than prepared once per cursor: a prepared plan
+    keeps the statistics of the temp tables it was planned against, and since clear_session()
+    refills the same tables for every request, it would prune rows of later requests.
+    """
+    parameters = dict(parameters or {})
+    if level is not None:
+        parameters["level"] = int(level)
+    query = query.format(level="$level")
+    con.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {table} AS select * from ({query}) as q limit 0", parameters or None
+    )
+    return con.execute(f"INSERT INTO {table} {query}", parameters or None)
+
+def insert_walked(con, table, walked, query, parameters=None):
+    """
+    Fill the session temp table `table` from `query`, which reads a graph walk as `walked`
+    and may use the named $parameters of `parameters`.
+    """
+    con.register("walked", walked)
+    try:
+        con.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} AS select * from ({query}) as q limit 0", parameters)
+        con.execute(f"INSERT INTO {table} BY NAME {query}", parameters)
+    finally:
+        con.unregister("walked")
+
+def normalize_nodes(nodes):
+    """
+    Sorted, de-duplicated tuple of node values, accepting a single string or a list.
+    """
+    if nodes is None:
+        return ()
+    if isinstance(nodes, str):
+        nodes = [nodes]
+    return tuple(sorted({str(node) for node in nodes}))
+
+def bind_nodes(con, table, nodes, role):
+    """
+    Load a list of start ('Source') or target ('Target') node values into a session node table.
+    """
+    con.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (node VARCHAR, role VARCHAR)")
+    con.execute(
+        f"INSERT INTO {table} select unnest(?::VARCHAR[]), ?", [list(normalize_nodes(nodes)), role]
+    )
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of get_lineage results, bounded by their total size in bytes.
+
+    Entries are tagged with the database version they were computed from. When a lookup
+    arrives with a different version the whole cache is dropped, since every entry is stale.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, version):
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, version, frame: pl.DataFrame):
+        size = frame.estimated_size()
+        with self._lock:
+            self._check_version(version)
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (frame, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
 
-DATABASE_URL = r"data/lineage.db"
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
 
-engine = duckdb.connect(DATABASE_URL, read_only=True)
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
 
-__all__ = ["get_lineage", "get_item_codes", "get_product_codes", "get_item_to_product_mapping"]
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._version = version
+
+class ProfiledCursor:
+    """
+    Wraps a pooled cursor for one profiled get_lineage request.
+
+    DuckDB profiling is switched on for the cursor, and after each statement its JSON profile is
+    kept together with the stage that ran it, set with profile_stage(): the func_* function
+    that issued it, 'final' for the result query in run_lineage, or the loader of a resident
+    structure. Everything except
+    execute() is passed through to the cursor. finish() stores the profiles under the request id
+    and switches profiling off again before the cursor returns to the pool.
+    """
+
+    def __init__(self, con, request_id):
+        self._con = con
+        self.request_id = request_id
+        self.statements = []
+        self._pending = None
+        con.execute("SET enable_profiling = 'no_output'")
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def execute(self, query, parameters=None):
+        self._record()
+        result = self._con.execute(query) if parameters is None else self._con.execute(query, parameters)
+        self._pending = current_stage.get()
+        return result
+
+    def finish(self):
+        try:
+            self._record()
+        finally:
+            self._con.execute("PRAGMA disable_profiling")
+            store_profile(self.request_id, self.statements)
+
+    def _record(self):
+        if self._pending is None:
+            return
+        profile = json.loads(self._con.get_profiling_information(format="json"))
+        self._pending, stage = None, self._pending
+        if not profile.get("query_name"):
+            return  # statements DuckDB does not profile
+        self.statements.append({
+            "stage": stage,
+            "query": profile["query_name"],
+            "latency": profile.get("latency"),
+            "profile": profile,
+        })
+
+class TraceGuard:
+    """
+    Stops a get_lineage request once its cancel token is set or its deadline passes.
+
+    A watchdog thread polls both and then interrupts every cursor handed to wrap(), which
+    aborts the statement DuckDB is running. The level loops run many short statements, so the
+    wrapped cursors also refuse to start a new one once the guard has fired. Leaving the guard
+    turns DuckDB's interrupt error into TraceCancelled or TraceTimeout.
+    """
+
+    def __init__(self, timeout=None, cancel=None):
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.cancel = cancel
+        self._cursors = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self.check()
+        threading.Thread(target=self._watch, name="lineage-trace-guard", daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        if isinstance(exc, duckdb.InterruptException) and self.fired():
+            raise self.error() from exc
+        return False
+
+    def fired(self) -> bool:
+        return (self.cancel is not None and self.cancel.is_set()) or (
+            self.deadline is not None and time.monotonic() >= self.deadline
+        )
+
+    def error(self) -> TraceCancelled:
+        if self.cancel is not None and self.cancel.is_set():
+            return TraceCancelled("The trace was cancelled.")
+        return TraceTimeout(f"The trace did not finish within {self.timeout} seconds.")
+
+    def check(self):
+        if self.fired():
+            raise self.error()
+
+    def acquire(self, slots):
+        """
+        Acquire the semaphore `slots`, waiting no longer than the deadline and giving up as soon
+        as the cancel token is set.
+        """
+        while True:
+            self.check()
+            wait = TRACE_POLL_SECONDS if self.cancel is not None else None
+            if self.deadline is not None:
+                remaining = max(self.deadline - time.monotonic(), 0)
+                wait = remaining if wait is None else min(wait, remaining)
+            if slots.acquire(timeout=wait):
+                return
+
+    def wrap(self, con):
+        """
+        Return `con` guarded: interrupted when the guard fires and checked before every statement.
+        """
+        with self._lock:
+            self._cursors.append(con)
+        return GuardedCursor(con, self)
+
+    def release(self, cursor):
+        """
+        Stop interrupting the cursor wrap() returned as `cursor`, before it goes back to the pool.
+        """
+        with self._lock:
+            self._cursors.remove(cursor._con)
+
+    def close(self):
+        """
+        Stop the watchdog. Once close() returns no cursor of the guard is interrupted any more,
+        so it must run before their sessions hand them back to the pool.
+        """
+        self._done.set()
+        with self._lock:
+            self._cursors.clear()
+
+    def _watch(self):
+        while not self._done.wait(TRACE_POLL_SECONDS):
+            if self.fired():
+                with self._lock:
+                    for con in self._cursors:
+                        con.interrupt()
+                return
+
+class GuardedCursor:
+    """
+    A pooled cursor whose execute() raises TraceCancelled or TraceTimeout once its TraceGuard
+    has fired. Everything else is passed through to the cursor.
+    """
+
+    def __init__(self, con, guard):
+        self._con = con
+        self._guard = guard
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def execute(self, query, parameters=None):
+        self._guard.check()
+        return self._con.execute(query) if parameters is None else self._con.execute(query, parameters)
+
+@contextmanager
+def profile_stage(name):
+    """
+    Attribute the statements profiled in the block to the trace stage `name`.
+    """
+    token = current_stage.set(name)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+def store_profile(request_id, statements):
+    with profiles_lock:
+        profiles[request_id] = statements
+        profiles.move_to_end(request_id)
+        while len(profiles) > PROFILE_STORE_SIZE:
+            profiles.popitem(last=False)
+
+def get_profile(request_id) -> list[dict]:
+    """
+    The statements profiled for a request, in execution order, each with its stage, query text,
+    latency in seconds and the full DuckDB JSON profile. Empty if the request is unknown.
+    """
+    with profiles_lock:
+        return list(profiles.get(request_id, []))
+
+def list_profiles() -> list[str]:
+    """
+    Ids of the stored profiled requests, newest first. Only the last PROFILE_STORE_SIZE are kept.
+    """
+    with profiles_lock:
+        return list(reversed(profiles))
+
+def slowest_operators(request_id, limit=10) -> list[dict]:
+    """
+    The slowest query plan operators of a profiled request, across all of its statements.
+
+    Returns:
+        list[dict]: stage, operator, timing (seconds), rows and the statement's query text,
+            slowest first.
+    """
+    operators = []
+    for statement in get_profile(request_id):
+        pending = list(statement["profile"].get("children", []))
+        while pending:
+            node = pending.pop()
+            pending.extend(node.get("children", []))
+            operators.append({
+                "stage": statement["stage"],
+                "operator": node.get("operator_name") or node.get("operator_type"),
+                "timing": node.get("operator_timing", 0.0),
+                "rows": node.get("operator_cardinality"),
+                "query": statement["query"],
+            })
+    return sorted(operators, key=lambda op: op["timing"], reverse=True)[:limit]
+
+def database_version(*paths):
+    """
+    Identify the current contents of the database files by their modification time and size.
+    """
+    version = []
+    for path in paths or (DATABASE_URL,):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            version.append(None)
+        else:
+            version.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+def cache_info() -> dict:
+    """
+    Hit, miss, eviction and size counters of the get_lineage result cache.
+    """
+    return result_cache.info()
+
+def clear_cache():
+    result_cache.clear()
+
+connection = duckdb.connect(DATABASE_URL, read_only=True)
+pool = CursorPool(connection)
+trace_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="lineage-trace")
+result_cache = ResultCache()
+graph = None
+graph_lock = threading.Lock()
+residents = {}
+resident_lock = threading.Lock()
+profiles = OrderedDict()
+profiles_lock = threading.Lock()
+current_stage = ContextVar("current_stage", default="final")  # stage of the statements being profiled
 
 def get_product_codes(search_value=None) -> list[dict]:
     """
     Fetch distinct Product Codes from ItemMaster, optionally filtered by search value.
-    
+
+    The codes are served from the in-memory catalog returned by get_product_index(), so a
+    keystroke does not touch the database.
+
     Args:
         search_value (str, optional): Search term to filter Product Codes.
-    
+
     Returns:
-        list[dict]: List of dictionaries with 'label' and 'value' for dropdown options.
+        list[dict]: List of dictionaries with 'label' and 'value' for dropdown options,
+            all Product Codes in order when there is no search value.
     """
-    query = """
-        SELECT DISTINCT ProductCode as product_code
-        FROM ItemMaster
-        WHERE ProductCode IS NOT NULL
+    return get_product_index().options(search_value, None)
+
+def get_item_codes(search_value, limit=SEARCH_LIMIT) -> list[dict]:
     """
-    if search_value:
-        query += f" AND ProductCode ILIKE '%{search_value}%'"
-    
-    result = engine.execute(query).pl()
-    
-    result_list = (
-        result.select([
-            pl.struct([
-                pl.col("product_code").alias("label"),
-                pl.col("product_code").alias("value")
-            ]).alias("product_dict")
-        ])
-        .select("product_dict")
-        .to_series()
-        .to_list()
-    )
-    
-    return sorted(result_list, key=lambda x: x['label'])
-
-def get_item_codes(search_value) -> list[dict]:
-    pr_in = engine.execute("""
-        SELECT types.ITEMCODE as "ItemCode", im.Category, im.ProductCode, im.Description, im.UnitOpName, im.tag
-        FROM vw_ListOfTypes types
-        LEFT JOIN ItemMaster im ON im.ItemCode = split_part(types.ITEMCODE, '-', 1)
-        WHERE types.ITEMCODE IS NOT NULL
-        AND types.ITEMCODE ILIKE '%{}%'
-    """.format(search_value)).pl()
-    
-    result_list = (
-        pr_in.with_columns([
-            pl.struct([
+    Item codes, lots and parent lots matching a search value, for the lot/item dropdowns.
+
+    Args:
+        search_value (str): Search term, matched case-insensitively anywhere in the code.
+        limit (int): Maximum number of options returned.
+
+    Returns:
+        list[dict]: Dropdown options with 'label' and 'value', exact and prefix matches first.
+    """
+    return get_item_index().options(search_value, limit)
+
+def get_item_index(con=None) -> SearchIndex:
+    """
+    Return the SearchIndex over vw_ListOfTypes used by get_item_codes, loading it on first use.
+
+    Codes are labelled with the ProductCode of their item, as 'ProductCode - Code'. Call it
+    once at startup to pay the build cost before the first keystroke.
+    """
+    def build(con):
+        pr_in = con.execute("""
+            SELECT types.ITEMCODE as "ItemCode", im.ProductCode
+            FROM vw_ListOfTypes types
+            LEFT JOIN ItemMaster im ON im.ItemCode = split_part(types.ITEMCODE, '-', 1)
+            WHERE types.ITEMCODE IS NOT NULL
+        """).pl()
+        return SearchIndex.from_frame(
+            pr_in.with_columns(
+                pl.col("ItemCode").alias("value"),
                 pl.when(pl.col("ProductCode").is_not_null())
                 .then(pl.col("ProductCode") + " - " + pl.col("ItemCode"))
                 .otherwise(pl.col("ItemCode"))
                 .alias("label"),
-                pl.col("ItemCode").alias("value")
-            ]).alias("item_dict")
-        ])
-        .select("item_dict")
-        .to_series()
-        .to_list()
-    )
-    
-    return result_list
+            )
+        )
+
+    return get_resident("item_index", build, con)
+
+def get_product_index(con=None) -> SearchIndex:
+    """
+    Return the catalog of distinct ItemMaster Product Codes used by get_product_codes.
+    """
+    def build(con):
+        result = con.execute("""
+            SELECT DISTINCT ProductCode as product_code
+            FROM ItemMaster
+            WHERE ProductCode IS NOT NULL
+        """).pl()
+        return SearchIndex(result["product_code"], result["product_code"])
+
+    return get_resident("product_index", build, con)
+
+def get_item_dimension(con=None) -> ItemDimension:
+    """
+    Return the resident ItemMaster copy used for item lookups and the lineage enrichment joins.
+    """
+    return get_resident("item_dimension", ItemDimension.load, con)
+
+def get_resident(name, build, con=None):
+    """
+    Return the in-memory structure `name` (search index, ItemMaster copy), building it with
+    build(con) on first use and again whenever the database file changes.
+
+    The build runs outside resident_lock: a caller without a cursor waits for a pool session
+    to build, and must not hold up callers that already hold one. Callers racing on a stale
+    structure may each build it; the first one stored is kept.
+    """
+    version = database_version()
+    with resident_lock:
+        resident = residents.get(name)
+    if resident is not None and resident.version == version:
+        return resident
+    with profile_stage("get_resident"):
+        if con is None:
+            with pool.session() as con:
+                resident = build(con)
+        else:
+            resident = build(con)
+    resident.version = version
+    with resident_lock:
+        current = residents.get(name)
+        if current is not None and current.version == version:
+            return current
+        residents[name] = resident
+    return resident
 
 def get_item_to_product_mapping(item_codes: set) -> dict:
     """
@@ -79,14 +609,8 @@ def get_item_to_product_mapping(item_codes: set) -> dict:
     """
     if not item_codes:
         return {}
-    
-    query = f"""
-        SELECT ItemCode, ProductCode
-        FROM ItemMaster
-        WHERE ItemCode IN ({','.join([f"'{code}'" for code in item_codes])})
-    """
-    result = engine.execute(query).pl().to_pandas()
-    return dict(zip(result['ItemCode'], result['ProductCode']))
+    with STAGE_SECONDS.time(stage="item_to_product_mapping"):
+        return get_item_dimension().product_codes(item_codes)
 
 def get_lineage(
     startNodes,
@@ -95,14 +619,94 @@ def get_lineage(
     GenOrTrc="all",
     level=-99,
     outputcols="default",
+    engine="sql",
+    use_cache=True,
+    profile=None,
+    progress=None,
+    timeout=None,
+    cancel=None,
 ):
     """
     Function to get the results of the query in the specified format.
     :param startNodes: list of Item codes, Lot Numbers, Parent Lot or Supplier Lot Numbers to trace.
+        A single string is treated as a one-element list.
     :param endNodes: list of Item codes, Lot Numbers, Parent Lot to target.
-    :param outputtype: The output type, either 'polars' or 'duckdb'.
+    :param outputtype: The output type: 'polars' for a DataFrame, 'duckdb' for a list of row
+        tuples, 'arrow_stream' for a pyarrow RecordBatchReader that keeps its pooled cursor until
+        it is read to the end or closed (use it as a context manager), or 'lazy' for a polars
+        LazyFrame over a private copy of the result, read in batches each time it is collected.
+    :param engine: 'sql' walks the batch graph one level at a time in SQL, 'closure' looks the
+        reachable batches up in the table materialized by build_closure(), 'csr' walks the
+        in-memory BatchGraph loaded by get_graph(). 'link' searches the BatchGraph from the start
+        and end nodes at once and returns only the batches on paths between them.
+    :param use_cache: Serve repeated queries from the result cache while the database is unchanged.
+    :param profile: Request id to record DuckDB query profiles of every statement under, see
+        get_profile() and slowest_operators(). True records under a new id, which is first in
+        list_profiles(). A profiled request always runs and needs a 'polars' or 'duckdb' output.
+    :param progress: Called with each stage of PROGRESS_STAGES as the trace reaches it. Not
+        called for results served from the cache.
+    :param timeout: Seconds the trace may take before it is interrupted with TraceTimeout.
+    :param cancel: Cancellation token, a threading.Event; setting it interrupts the trace with
+        TraceCancelled. Either way the request's cursors are closed, dropping its temp tables.
+        For 'arrow_stream' and 'lazy' both cover building the trace, not reading the result.
     :return: The result of the query in the specified format.
     """
+    return run_lineage(
+        startNodes, endNodes, outputtype, GenOrTrc, level, outputcols, engine, use_cache, profile=profile,
+        progress=progress, timeout=timeout, cancel=cancel,
+    )
+
+def get_lineage_many(
+    startSets,
+    endNodes=None,
+    outputtype="polars",
+    GenOrTrc="all",
+    level=-99,
+    outputcols="default",
+    engine="sql",
+    use_cache=True,
+    profile=None,
+    timeout=None,
+    cancel=None,
+):
+    """
+    Trace many start sets in one traversal, e.g. all the lots of a recall.
+
+    The nodes of every set are resolved and traced together, so temp tables and scans are paid
+    once for the whole batch instead of once per set. Each result row is attributed back to the
+    set(s) whose nodes resolved to its root lot, in a leading query_root column.
+    :param startSets: dict mapping a root id to its start nodes, or a list of start node lists,
+        whose positions are used as root ids. query_root holds the id as a string.
+    :param endNodes: list of Item codes, Lot Numbers, Parent Lot to target, shared by all sets.
+    :param timeout: Seconds the traversal may take, as for get_lineage.
+    :param cancel: Cancellation token for the traversal, as for get_lineage.
+    :return: The result of the query in the specified format, as for get_lineage. A row that
+        belongs to several start sets is returned once per set.
+    """
+    if not isinstance(startSets, dict):
+        startSets = dict(enumerate(startSets))
+    queryRoots = tuple(
+        (str(root), node) for root, nodes in startSets.items() for node in normalize_nodes(nodes)
+    )
+    startNodes = [node for _, node in queryRoots]
+    return run_lineage(
+        startNodes, endNodes, outputtype, GenOrTrc, level, outputcols, engine, use_cache,
+        queryRoots=tuple(sorted(queryRoots)), profile=profile, timeout=timeout, cancel=cancel,
+    )
+
+def run_lineage(
+    startNodes, endNodes, outputtype, GenOrTrc, level, outputcols, engine, use_cache, queryRoots=None, profile=None,
+    progress=None, timeout=None, cancel=None, from_level=1,
+):
+    if engine not in ("sql", "closure", "csr", "link"):
+        raise ValueError("Invalid engine. Use 'sql', 'closure', 'csr' or 'link'.")
+    if engine == "link" and endNodes is None:
+        raise ValueError("The 'link' engine needs endNodes to link to.")
+    if outputtype not in ("polars", "duckdb", "arrow_stream", "lazy"):
+        raise ValueError("Invalid output type. Use 'polars', 'duckdb', 'arrow_stream' or 'lazy'.")
+    if profile and outputtype not in ("polars", "duckdb"):
+        raise ValueError("Profiling needs the 'polars' or 'duckdb' output type.")
+
     if level == -99:
         qrylevel = 99
     elif level is None:
@@ -110,168 +714,665 @@ def get_lineage(
     else:
         qrylevel = level
 
-    func_Source(startNodes, GenOrTrc, qrylevel)  # refresh trace temp tables
+    if engine == "closure":
+        attach_closure()
 
-    if endNodes is not None:
-        func_Target(endNodes)  # refresh target temp tables
-        strwheretrc = " where EXISTS (select 1 from tmp_tracetarget WHERE lot_number = product_lot)"
-        strwheregen = " where EXISTS (select 1 from tmp_tracetarget WHERE lot_number = ingredient_lot)"
-    else:
-        strwheretrc = " where 1=1"
-        strwheregen = " where 1=1"
+    cache_key = (
+        normalize_nodes(startNodes),
+        normalize_nodes(endNodes) if endNodes is not None else None,
+        GenOrTrc,
+        qrylevel,
+        " ".join(outputcols.split()) if outputcols else outputcols,
+        engine,
+        queryRoots,
+        from_level,
+    )
+    version = database_version(DATABASE_URL, CLOSURE_URL) if engine == "closure" else database_version()
+    REQUESTS.inc(engine=engine)
+    result = result_cache.get(cache_key, version) if use_cache and not profile else None
+    if use_cache and not profile:
+        CACHE_REQUESTS.inc(result="miss" if result is None else "hit")
+    if result is not None:
+        ROWS_RETURNED.inc(result.height)
+        return convert_result(result, outputtype)
 
-    # Execute Gen or Trc or Both queries
-    qrystrGen, qrystrTrc = "", ""
+    with ExitStack() as stack:
+        guard = None
+        if timeout is not None or cancel is not None:
+            guard = stack.enter_context(TraceGuard(timeout, cancel))
+        con = stack.enter_context(pool.session(guard=guard))
+        if guard is not None:
+            stack.callback(guard.close)  # runs before the session returns the cursor to the pool
+        stack.enter_context(REQUESTS_IN_FLIGHT.track())
+        if profile:
+            con = ProfiledCursor(con, str(uuid.uuid4()) if profile is True else str(profile))
+            stack.callback(con.finish)
+        if guard is not None:
+            con = guard.wrap(con)
+        if progress:
+            progress("resolving nodes")
+        with STAGE_SECONDS.time(stage="node_resolution"):
+            with profile_stage("func_Nodes"):
+                func_Nodes(con, startNodes, endNodes)  # resolve start and target nodes in one pass
+            if endNodes is not None:
+                with profile_stage("func_Target"):
+                    func_Target(con)  # refresh target temp tables
 
-    if GenOrTrc == "trc" or GenOrTrc == "all":
-        qrystrTrc = f"""
-        select 'Trc'as type, 
-        root_itemcode as root_itemcode,
-        root_parentlot as root_parentlot,
-        root_lot as root_lot,
-        root_supplierlot as root_supplierlot,
-        level,
-        product_itemcode as product_itemcode,
-        product_lot as product_lot,
-        product_pln as product_parentlot,
-        CASE WHEN level = 1 THEN root_itemcode ELSE ingredient_itemcode END as ingredient_itemcode,
-        CASE WHEN level = 1 THEN root_lot ELSE ingredient_lot END as ingredient_lot,
-        CASE WHEN level = 1 THEN root_supplierlot ELSE ingredient_supplierlot END as ingredient_supplierlot,
-        CASE WHEN level = 1 THEN root_parentlot ELSE ingredient_pln END as ingredient_ParentLot,
-        level as sortorder
-        from vw_trc_results
-        {strwheretrc}
-        """
-    if GenOrTrc == "gen" or GenOrTrc == "all":
-        qrystrGen = f"""select 'Gen' as type, 
-        root_itemcode as root_itemcode,
-        root_parentlot as root_parentlot,
-        root_lot as root_lot,
-        'NA' as root_supplierlot,
-        level,
-        product_itemcode as product_itemcode,
-        product_lot as product_lot,
-        Product_PLN as product_parentlot,
-        ingredient_itemcode as ingredient_itemcode,
-        ingredient_lot as ingredient_lot,
-        supplierlot as ingredient_supplierlot ,
-        ingredient_pln as ingredient_ParentLot,
-        level * -1 as sortorder
-        from vw_gen_results
-        {strwheregen}
-        """
+        # 'all' traces Gen on a second cursor when one is free, never waiting for it, so requests
+        # holding one session cannot deadlock on the pool. Profiles cover one cursor only.
+        if GenOrTrc == "all" and not profile:
+            with pool.session(blocking=False) as helper:
+                if guard is not None and helper is not None:
+                    helper = guard.wrap(helper)
+                try:
+                    with profile_stage("func_Source"):
+                        func_Source(con, GenOrTrc, qrylevel, engine, helper, progress, from_level)  # refresh trace temp tables
+                finally:
+                    if isinstance(helper, GuardedCursor):
+                        guard.release(helper)
+        else:
+            with profile_stage("func_Source"):
+                func_Source(con, GenOrTrc, qrylevel, engine, progress=progress, from_level=from_level)  # refresh trace temp tables
+        if queryRoots is not None:
+            with profile_stage("func_QueryRoots"):
+                func_QueryRoots(con, queryRoots)
 
-    if qrystrGen != "" and qrystrTrc != "":
-        qrystr = f"""
-        select * from ({qrystrGen} union all by name {qrystrTrc}) as t
-        """
-    elif qrystrGen != "" and qrystrTrc == "":
-        qrystr = qrystrGen
-    elif qrystrGen == "" and qrystrTrc != "":
-        qrystr = qrystrTrc
-    else:
-        raise ValueError("No query to execute. Please check the input parameters.")
-    
-    qrystr = f"""
-            select *, im_root.UnitOpName as root_unit_op_name,
-            im_root.Description as root_description,
-            im_product.UnitOpName as product_unit_op_name,
-            im_product.Description as product_description,
-            im_ingredient.UnitOpName as ingredient_unit_op_name,
-            im_ingredient.Description as ingredient_description
+        if endNodes is not None and engine != "link":
+            strwheretrc = " where EXISTS (select 1 from tmp_tracetarget WHERE lot_number = product_lot)"
+            strwheregen = " where EXISTS (select 1 from tmp_tracetarget WHERE lot_number = ingredient_lot)"
+        else:
+            strwheretrc = " where 1=1"
+            strwheregen = " where 1=1"
+
+        # Execute Gen or Trc or Both queries
+        qrystrGen, qrystrTrc = "", ""
+
+        if GenOrTrc == "trc" or GenOrTrc == "all":
+            qrystrTrc = f"""
+            select 'Trc'as type, 
+            root_itemcode as root_itemcode,
+            root_parentlot as root_parentlot,
+            root_lot as root_lot,
+            root_supplierlot as root_supplierlot,
+            level,
+            product_itemcode as product_itemcode,
+            product_lot as product_lot,
+            product_pln as product_parentlot,
+            CASE WHEN level = 1 THEN root_itemcode ELSE ingredient_itemcode END as ingredient_itemcode,
+            CASE WHEN level = 1 THEN root_lot ELSE ingredient_lot END as ingredient_lot,
+            CASE WHEN level = 1 THEN root_supplierlot ELSE ingredient_supplierlot END as ingredient_supplierlot,
+            CASE WHEN level = 1 THEN root_parentlot ELSE ingredient_pln END as ingredient_ParentLot,
+            level as sortorder
+            from vw_trc_results
+            {strwheretrc}
+            """
+        if GenOrTrc == "gen" or GenOrTrc == "all":
+            qrystrGen = f"""select 'Gen' as type, 
+            root_itemcode as root_itemcode,
+            root_parentlot as root_parentlot,
+            root_lot as root_lot,
+            'NA' as root_supplierlot,
+            level,
+            product_itemcode as product_itemcode,
+            product_lot as product_lot,
+            Product_PLN as product_parentlot,
+            ingredient_itemcode as ingredient_itemcode,
+            ingredient_lot as ingredient_lot,
+            supplierlot as ingredient_supplierlot ,
+            ingredient_pln as ingredient_ParentLot,
+            level * -1 as sortorder
+            from vw_gen_results
+            {strwheregen}
+            """
+
+        if qrystrGen != "" and qrystrTrc != "":
+            qrystr = f"""
+            select * from ({qrystrGen} union all by name {qrystrTrc}) as t
+            """
+        elif qrystrGen != "" and qrystrTrc == "":
+            qrystr = qrystrGen
+        elif qrystrGen == "" and qrystrTrc != "":
+            qrystr = qrystrTrc
+        else:
+            raise ValueError("No query to execute. Please check the input parameters.")
+
+        if progress:
+            progress("enriching")
+        dimension = get_item_dimension(con)
+
+        if queryRoots is not None:
+            # attribute each row to the start sets whose nodes resolved to its root lot
+            qrystr = f"""
+            select q.query_root, t.*
             from ({qrystr}) as t
-            LEFT JOIN ItemMaster as im_root ON im_root.ItemCode = t.root_itemcode
-            LEFT JOIN ItemMaster as im_product ON im_product.ItemCode = t.product_itemcode
-            LEFT JOIN ItemMaster as im_ingredient ON im_ingredient.ItemCode = t.ingredient_itemcode
-        """
+                JOIN tmp_QueryRootLots q ON q.Lot_Number = t.root_lot
+                    AND q.TYPE = CASE WHEN t.type = 'Trc' THEN 'Ingredient' ELSE 'Product' END
+            """
 
-    # Dynamic output columns handling
-    if outputcols == "default" or outputcols is None:
-        qrystr = qrystr
-    elif "exclude" in outputcols.lower():
-        qrystr = f"""
-        select * {outputcols}, count(*) as CntRecs from ({qrystr}) as t
-        group by all
-        """
-    else:
-        # Remove duplicate CntRecs to avoid CntRecs_1
-        qrystr = f"""
-        select {outputcols} from ({qrystr}) as t
-        group by all
-        having count(*) > 0
-        """
-    
-    if outputtype == "polars":
-        return engine.execute(qrystr).pl()
-    elif outputtype == "duckdb":
-        return engine.execute(qrystr).fetchall()
-    else:
-        raise ValueError("Invalid output type. Use 'polars' or 'duckdb'.")
+        # Explicit column lists are grouped on the narrow trace columns before ItemMaster is joined
+        late = None
+        if outputcols not in ("default", None) and "exclude" not in outputcols.lower():
+            late = late_enriched_query(qrystr, f"{'query_root, ' if queryRoots is not None else ''}{outputcols}")
 
-def func_trc_PrBID(level):
-    engine.execute(
-        """
-        CREATE OR REPLACE TEMP TABLE vw_Trc_PrBID AS 
-        select 
-            PRODUCTBATCHID, p.Lot_Number, p.ItemCode, mt.SLNADJ, mt.PLN
-        from tmp_TraceForLots p
-            JOIN vw_trc_PIBID mt on p.ItemCode = mt.ItemCode
-        WHERE 1=1 AND mt.Type='Ingredient' 
-        AND p.lot_number = mt.LOT_NUMBER 
-        group by ProductBatchID, p.Lot_Number, p.ItemCode, mt.slnadj, mt.pln
-        """
-    )
+        # ItemMaster is joined on by lookups in the resident copy. The default output is enriched
+        # as it is read, grouped outputs group the enriched rows registered on the cursor.
+        enrich = None
+        if late is not None:
+            grouped, joins, qrystr = late
+            with STAGE_SECONDS.time(stage="enrichment"):
+                con.register("grouped_trace", dimension.enrich(con.execute(grouped).pl(), joins))
+            stack.callback(con.unregister, "grouped_trace")
+        elif outputcols == "default" or outputcols is None:
+            enrich = partial(enrich_default, dimension)
+        else:
+            with STAGE_SECONDS.time(stage="enrichment"):
+                con.register("enriched_trace", enrich_default(dimension, con.execute(qrystr).pl()))
+            stack.callback(con.unregister, "enriched_trace")
+            if "exclude" in outputcols.lower():
+                qrystr = f"""
+                select * {outputcols}, count(*) as CntRecs from enriched_trace as t
+                group by all
+                """
+            else:
+                # Remove duplicate CntRecs to avoid CntRecs_1
+                qrystr = f"""
+                select {"query_root, " if queryRoots is not None else ""}{outputcols} from enriched_trace as t
+                group by all
+                having count(*) > 0
+                """
+
+        # streamed results are not cached, they hand the session over to their reader
+        if guard is not None and outputtype in ("arrow_stream", "lazy"):
+            guard.close()
+        if outputtype == "arrow_stream":
+            return stream_result(con, qrystr, stack.pop_all(), enrich)
+        if outputtype == "lazy":
+            return scan_result(con, qrystr, stack.pop_all(), enrich)
+        with STAGE_SECONDS.time(stage="result_select"):
+            result = con.execute(qrystr).pl()
+        if enrich is not None:
+            with STAGE_SECONDS.time(stage="enrichment"):
+                result = enrich(result)
+        ROWS_RETURNED.inc(result.height)
+
+    if use_cache:
+        result_cache.put(cache_key, version, result)
+    return convert_result(result, outputtype)
 
-    engine.execute(
-        f"""
-        CREATE OR REPLACE TEMP TABLE tmp_Trc_Results_bid AS
-        with recursive 
-        pbid as
-    (
-        select ProductBatchID, IngredientBatchID, ItemCode, Lot_Number
-        from vw_trc_PIBID
+TRACE_COLUMNS = {
+    "query_root", "type", "root_itemcode", "root_parentlot", "root_lot", "root_supplierlot", "level",
+    "product_itemcode", "product_lot", "product_parentlot", "ingredient_itemcode", "ingredient_lot",
+    "ingredient_supplierlot", "ingredient_parentlot", "sortorder",
+}
+ENRICHMENT_COLUMNS = {
+    "root_unit_op_name": ("im_root", "UnitOpName"),
+    "root_description": ("im_root", "Description"),
+    "product_unit_op_name": ("im_product", "UnitOpName"),
+    "product_description": ("im_product", "Description"),
+    "ingredient_unit_op_name": ("im_ingredient", "UnitOpName"),
+    "ingredient_description": ("im_ingredient", "Description"),
+}
+ENRICHMENT_JOINS = {
+    "im_root": "root_itemcode",
+    "im_product": "product_itemcode",
+    "im_ingredient": "ingredient_itemcode",
+}
+
+def enrich_default(dimension, frame):
+    """
+    Join ItemMaster onto trace rows for the root, product and ingredient item codes, as the
+    default output shows it: every ItemMaster column of each join, repeated ones suffixed _1, _2
+    the way DuckDB names them, then the six ENRICHMENT_COLUMNS.
+    """
+    suffixes = dict(zip(ENRICHMENT_JOINS, ("", "_1", "_2")))
+    frame = dimension.enrich(frame, [
+        (code, [(col, f"{col}{suffixes[join]}") for col in dimension.schema])
+        for join, code in ENRICHMENT_JOINS.items()
+    ])
+    return frame.with_columns(
+        pl.col(f"{source}{suffixes[join]}").alias(name) for name, (join, source) in ENRICHMENT_COLUMNS.items()
     )
-    ,
-    r as
-    (
-        select 
-        C.ProductBatchid, 
-        null as IngredientBatchID,
-        CAST('NANCHOR' as nvarchar(50)) AS ItemCode, 
-        CAST('NANCHOR' as nvarchar(50)) AS Lot_Number, 
-        1 as Level, 
-        C.Lot_Number as Parent,
-        C.itemcode as ParentItemCode,
-        C.SLNADJ, 
-        C.PLN ParentPLN
-        from vw_Trc_PrBID C
-        GROUP BY C.ProductBatchID, C.LOT_NUMBER, C.ItemCode, 
-        C.SLNADJ, C.PLN
-
-        union all 
-
-        select 
-        d.ProductBatchID, 
-        d.IngredientBatchID, 
-        CAST(d.ItemCode as nvarchar(50)) AS ItemCode,
-        CAST(d.LOT_NUMBER as nvarchar(50)) AS LOT_NUMBER,
-        r.Level + 1,
-        r.Parent,
-        r.ParentItemCode,
-        R.SLNADJ,
-        R.ParentPLN
-        from r, pbid d 
-        where 
-        r.ProductBatchID = d.IngredientBatchID 
-        AND r.level< {level}
+
+def late_enriched_query(trace, selectcols):
+    """
+    Rewrite an outputcols grouping so it counts on the narrow trace columns first and joins
+    the ItemMaster descriptions and unit-op names onto the aggregated rows only.
+
+    Applies when every select item is a trace column or one of the enrichment columns, optionally
+    aliased, or count(*). The partial counts are summed after the join, so the result matches
+    grouping the fully enriched rows. Returns None for anything else, which keeps the original
+    enrich-then-group query.
+
+    Returns:
+        tuple: The grouping query, the ItemDimension.enrich() joins for its rows, and the final
+            query over the enriched rows registered as grouped_trace.
+    """
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(selectcols):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            items.append(selectcols[start:i])
+            start = i + 1
+    items.append(selectcols[start:])
+
+    keys, joins, select = set(), {}, []
+    for item in items:
+        count = re.fullmatch(r"\s*count\(\s*\*\s*\)(?:\s+as\s+(\w+))?\s*", item, re.IGNORECASE)
+        if count:
+            alias = count.group(1) or '"count_star()"'
+            select.append(f"sum(cnt)::BIGINT as {alias}")
+            continue
+        column = re.fullmatch(r"\s*(\w+)(?:\s+as\s+(\w+))?\s*", item, re.IGNORECASE)
+        if column is None:
+            return None
+        # without an alias a column keeps the name the trace or enrichment query gives it
+        name, alias = column.group(1), column.group(2)
+        if name.lower() in TRACE_COLUMNS:
+            keys.add(name.lower())
+            select.append(f"g.{name} as {alias}" if alias else f"g.{name}")
+        elif name.lower() in ENRICHMENT_COLUMNS:
+            join, source = ENRICHMENT_COLUMNS[name.lower()]
+            keys.add(ENRICHMENT_JOINS[join])
+            joins.setdefault(join, set()).add(source)
+            select.append(f"g.{join}_{source} as {alias or name.lower()}")
+        else:
+            return None
+
+    if not keys:
+        return None
+    grouped = f"""
+            select {", ".join(sorted(keys))}, count(*) as cnt
+            from ({trace}) as t
+            group by all
+            """
+    enrich = [
+        (ENRICHMENT_JOINS[join], [(source, f"{join}_{source}") for source in sorted(joins[join])])
+        for join in sorted(joins)
+    ]
+    return grouped, enrich, f"""
+            select {", ".join(select)}
+            from grouped_trace as g
+            group by all
+            """
+
+def convert_result(result, outputtype):
+    """
+    Return a materialized get_lineage result in the requested output type.
+    """
+    if outputtype == "duckdb":
+        return result.rows()
+    if outputtype == "arrow_stream":
+        return result.to_arrow().to_reader()
+    if outputtype == "lazy":
+        return result.lazy()
+    return result
+
+def result_schema(con, qrystr, enrich=None):
+    """
+    Polars schema of a get_lineage query, with repeated column names suffixed _1, _2 the way
+    DuckDB does when it converts a result to polars, after `enrich` when one is given.
+    """
+    empty = con.execute(f"select * from ({qrystr}) as t limit 0").pl()
+    return (empty if enrich is None else enrich(empty)).schema
+
+class ResultStream:
+    """
+    The pyarrow RecordBatchReader of an 'arrow_stream' result, together with the pool session
+    its batches are read from.
+
+    pyarrow's close() on a reader made from a generator does not close the generator, so the
+    session would only be released once the reader is garbage collected. Closing the stream, or
+    leaving it as a context manager, closes the generator too. Everything else, including the
+    Arrow C stream interface, is passed through to the reader.
+    """
+
+    def __init__(self, reader, batches):
+        self._reader = reader
+        self._batches = batches
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
+
+    def __iter__(self):
+        return iter(self._reader)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __arrow_c_stream__(self, requested_schema=None):
+        return self._reader.__arrow_c_stream__(requested_schema)
+
+    def close(self):
+        try:
+            self._reader.close()
+        finally:
+            self._batches.close()
+
+def stream_result(con, qrystr, session, enrich=None):
+    """
+    Stream a get_lineage query as pyarrow record batches, releasing the pool session behind it as
+    soon as the stream is read to the end, closed or garbage collected. The session is released
+    at once when the query fails. `enrich` is applied to every batch as a polars DataFrame.
+    """
+    try:
+        names = list(result_schema(con, qrystr))
+        reader = con.execute(qrystr).fetch_record_batch(ARROW_BATCH_ROWS)
+    except BaseException:
+        session.close()
+        raise
+
+    def batches():
+        with session:
+            yield
+            for batch in reader:
+                batch = batch.rename_columns(names)
+                if enrich is None:
+                    yield batch
+                else:
+                    yield from enrich(pl.from_arrow(batch)).to_arrow().to_batches()
+
+    stream = batches()
+    next(stream)  # enter the session now, so closing an unread stream still releases it
+    schema = pa.schema([field.with_name(name) for field, name in zip(reader.schema, names)])
+    if enrich is not None:
+        schema = enrich(pl.from_arrow(schema.empty_table())).to_arrow().schema
+    return ResultStream(pa.RecordBatchReader.from_batches(schema, stream), stream)
+
+def scan_result(con, qrystr, session, enrich=None):
+    """
+    LazyFrame over a get_lineage query whose temp tables are held by `session`.
+
+    The query's result is copied into a private in-memory DuckDB connection and the session is
+    released before returning, so a LazyFrame kept alive never holds a pool cursor. Every collect
+    reads the copy in record batches. Row limits are pushed into DuckDB, `enrich`, predicates and
+    projections are applied batch by batch.
+    """
+    with session:
+        names = list(result_schema(con, qrystr))
+        schema = result_schema(con, qrystr, enrich)
+        reader = con.execute(qrystr).fetch_record_batch(ARROW_BATCH_ROWS)
+        renamed = pa.RecordBatchReader.from_batches(
+            pa.schema([field.with_name(name) for field, name in zip(reader.schema, names)]),
+            (batch.rename_columns(names) for batch in reader),
         )
-        select * from r
-        """
+        private = duckdb.connect()
+        private.register("trace_result", renamed)
+        private.execute("CREATE TABLE trace_result_copy AS select * from trace_result")
+        private.unregister("trace_result")
+    lock = threading.Lock()
+
+    def scan(with_columns, predicate, n_rows, batch_size):
+        query = "select * from trace_result_copy"
+        if n_rows is not None and predicate is None:
+            query = f"{query} limit {int(n_rows)}"
+        with lock:
+            reader = private.execute(query).fetch_record_batch(batch_size or ARROW_BATCH_ROWS)
+            for batch in reader:
+                frame = pl.from_arrow(batch)
+                if enrich is not None:
+                    frame = enrich(frame)
+                if predicate is not None:
+                    frame = frame.filter(predicate)
+                if with_columns is not None:
+                    frame = frame.select(with_columns)
+                if n_rows is not None:
+                    frame = frame.head(n_rows)
+                    n_rows -= frame.height
+                yield frame
+                if n_rows == 0:
+                    break
+
+    return register_io_source(scan, schema=schema)
+
+def get_lineage_frontier(nodes, direction, from_level, to_level, outputtype="polars", engine="sql"):
+    """
+    Get only the levels from_level..to_level of a trace, for expanding a lineage on demand.
+
+    The walk is seeded with the frontier of a trace that is already loaded, the lots reached at
+    level from_level - 1, and stops at to_level, so each expansion only pays for the levels it
+    returns. Levels continue those of the loaded trace, and the root columns describe the
+    frontier lot a row was expanded from. A batch the loaded trace reached at a lower level
+    through another branch is reported again, as the expansion only knows the frontier.
+    :param nodes: The frontier to expand: for from_level 1 the start nodes of the trace, as for
+        get_lineage, otherwise the lots at level from_level - 1 of the loaded trace, its
+        product_lot for 'trc' or its ingredient_lot for 'gen'.
+    :param direction: 'trc' to go forward into products, 'gen' to go back into ingredients.
+    :param from_level: First level to return, 1 being the links of the start nodes themselves.
+    :param to_level: Last level to return.
+    :param outputtype: The output type, either 'polars' or 'duckdb', as for get_lineage.
+    :param engine: Trace engine, see get_lineage.
+    :return: The rows of levels from_level..to_level.
+    """
+    if direction not in ("trc", "gen"):
+        raise ValueError("Invalid direction. Use 'trc' or 'gen'.")
+    if not 1 <= from_level <= to_level:
+        raise ValueError("Levels must satisfy 1 <= from_level <= to_level.")
+    if outputtype not in ("polars", "duckdb"):
+        raise ValueError("Invalid output type. Use 'polars' or 'duckdb'.")
+
+    return run_lineage(
+        nodes, None, outputtype, direction, to_level, "default", engine, use_cache=True, from_level=from_level,
     )
 
-    engine.execute(
+def func_trc_PrBID(con, level, engine="sql", from_level=1):
+    # The anchors are the batches consuming the root lots, at level 1. A trace seeded with the
+    # frontier of a loaded trace anchors on the batches that made the frontier lots instead, at
+    # level from_level - 1, and drops the anchors once the levels after them are walked.
+    anchor = max(from_level - 1, 1)
+    if from_level > 1:
+        run_insert(
+            con,
+            "vw_Trc_PrBID",
+            """
+            select 
+                m.BATCH_ID as ProductBatchID, p.Lot_Number, p.ItemCode, m.SLNADJ, m.PLN
+            from tmp_TraceForLots p
+                JOIN mat_txns m on p.ItemCode = m.ItemCode
+            WHERE 1=1 AND m.TYPE='Product' 
+            AND p.lot_number = m.LOT_NUMBER 
+            group by m.BATCH_ID, p.Lot_Number, p.ItemCode, m.slnadj, m.pln
+            """,
+        )
+    else:
+        run_insert(
+            con,
+            "vw_Trc_PrBID",
+            """
+            select 
+                PRODUCTBATCHID, p.Lot_Number, p.ItemCode, mt.SLNADJ, mt.PLN
+            from tmp_TraceForLots p
+                JOIN vw_trc_PIBID mt on p.ItemCode = mt.ItemCode
+            WHERE 1=1 AND mt.Type='Ingredient' 
+            AND p.lot_number = mt.LOT_NUMBER 
+            group by ProductBatchID, p.Lot_Number, p.ItemCode, mt.slnadj, mt.pln
+            """,
+        )
+
+    # A root lot consumed by several batches reaches a link through each of them; the closure
+    # and graph engines keep its minimum level per root lot, as the sql step's visited set does.
+    if engine == "closure":
+        run_insert(
+            con,
+            "tmp_Trc_Results_bid",
+            """
+            with
+            c as
+            (
+                select ProductBatchID, Lot_Number, ItemCode, SLNADJ, PLN
+                from vw_Trc_PrBID
+                GROUP BY ALL
+            )
+            select 
+                c.ProductBatchID,
+                null as IngredientBatchID,
+                CAST('NANCHOR' as nvarchar(50)) AS ItemCode, 
+                CAST('NANCHOR' as nvarchar(50)) AS Lot_Number, 
+                $anchor::INTEGER as Level, 
+                c.Lot_Number as Parent,
+                c.ItemCode as ParentItemCode,
+                c.SLNADJ, 
+                c.PLN ParentPLN
+            from c
+
+            union all
+
+            select 
+                d.ProductBatchID, 
+                d.IngredientBatchID, 
+                CAST(d.ItemCode as nvarchar(50)) AS ItemCode,
+                CAST(d.LOT_NUMBER as nvarchar(50)) AS LOT_NUMBER,
+                min(cl.MinLevel) + $anchor + 1 as Level,
+                c.Lot_Number as Parent,
+                c.ItemCode as ParentItemCode,
+                c.SLNADJ,
+                c.PLN ParentPLN
+            from c
+                JOIN closure.BatchClosure cl ON cl.Direction = 'Trc'
+                    AND cl.AncestorBatchID = c.ProductBatchID
+                    AND cl.MinLevel + $anchor + 1 <= {level}
+                JOIN vw_trc_PIBID d ON d.IngredientBatchID = cl.DescendantBatchID
+            GROUP BY ALL
+            """,
+            level,
+            {"anchor": anchor},
+        )
+    elif engine in ("csr", "link"):
+        roots = con.execute("select distinct ProductBatchID from vw_Trc_PrBID").pl()
+        if engine == "link":
+            targets = con.execute(
+                """
+                select distinct BATCH_ID
+                from mat_txns
+                where TYPE = 'Product'
+                AND LOT_NUMBER in (select Lot_Number from tmp_TraceTarget)
+                """
+            ).pl()
+            walked = get_graph(con).link("Trc", roots["ProductBatchID"], targets["BATCH_ID"], level, first_level=2)
+            # only roots that reach a target, or are one, anchor a path
+            linked = pl.concat([walked["RootBatchID"], targets["BATCH_ID"].cast(walked["RootBatchID"].dtype)])
+            con.execute(
+                "DELETE FROM vw_Trc_PrBID WHERE ProductBatchID NOT IN (select unnest(?))",
+                [linked.unique().to_list()],
+            )
+        else:
+            walked = get_graph(con).walk("Trc", roots["ProductBatchID"], level, first_level=anchor + 1)
+        insert_walked(
+            con,
+            "tmp_Trc_Results_bid",
+            walked,
+            """
+            with
+            c as
+            (
+                select ProductBatchID, Lot_Number, ItemCode, SLNADJ, PLN
+                from vw_Trc_PrBID
+                GROUP BY ALL
+            )
+            select 
+                c.ProductBatchID,
+                null as IngredientBatchID,
+                CAST('NANCHOR' as nvarchar(50)) AS ItemCode, 
+                CAST('NANCHOR' as nvarchar(50)) AS Lot_Number, 
+                $anchor::INTEGER as Level, 
+                c.Lot_Number as Parent,
+                c.ItemCode as ParentItemCode,
+                c.SLNADJ, 
+                c.PLN ParentPLN
+            from c
+
+            union all
+
+            select 
+                d.ProductBatchID, 
+                d.IngredientBatchID, 
+                CAST(d.ItemCode as nvarchar(50)) AS ItemCode,
+                CAST(d.Lot_Number as nvarchar(50)) AS Lot_Number,
+                min(d.Level) as Level,
+                c.Lot_Number as Parent,
+                c.ItemCode as ParentItemCode,
+                c.SLNADJ,
+                c.PLN ParentPLN
+            from c
+                JOIN walked d ON d.RootBatchID = c.ProductBatchID
+            GROUP BY ALL
+            """,
+            {"anchor": anchor},
+        )
+    else:
+        run_insert(
+            con,
+            "tmp_Trc_Results_bid",
+            """
+            select 
+            C.ProductBatchid, 
+            null as IngredientBatchID,
+            CAST('NANCHOR' as nvarchar(50)) AS ItemCode, 
+            CAST('NANCHOR' as nvarchar(50)) AS Lot_Number, 
+            $anchor::INTEGER as Level, 
+            C.Lot_Number as Parent,
+            C.itemcode as ParentItemCode,
+            C.SLNADJ, 
+            C.PLN ParentPLN
+            from vw_Trc_PrBID C
+            GROUP BY C.ProductBatchID, C.LOT_NUMBER, C.ItemCode, 
+            C.SLNADJ, C.PLN
+            """,
+            parameters={"anchor": anchor},
+        )
+        # Expand one level at a time from the batches each root reached first at the
+        # previous level, so reconverging paths are walked once instead of once per path.
+        for lvl in range(anchor, level):
+            inserted = run_insert(
+                con,
+                "tmp_Trc_Results_bid",
+                """
+                with
+                f as
+                (
+                    select ProductBatchID, Parent, ParentItemCode, SLNADJ, ParentPLN
+                    from tmp_Trc_Results_bid r
+                    where r.Level = {level}
+                    AND NOT EXISTS (
+                        select 1 from tmp_Trc_Results_bid v
+                        where v.Level < {level}
+                        AND v.ProductBatchID = r.ProductBatchID
+                        AND v.Parent = r.Parent
+                        AND v.ParentItemCode IS NOT DISTINCT FROM r.ParentItemCode
+                        AND v.SLNADJ IS NOT DISTINCT FROM r.SLNADJ
+                        AND v.ParentPLN IS NOT DISTINCT FROM r.ParentPLN
+                    )
+                    GROUP BY ALL
+                )
+                select 
+                d.ProductBatchID, 
+                d.IngredientBatchID, 
+                CAST(d.ItemCode as nvarchar(50)) AS ItemCode,
+                CAST(d.LOT_NUMBER as nvarchar(50)) AS LOT_NUMBER,
+                {level} + 1 as Level,
+                f.Parent,
+                f.ParentItemCode,
+                f.SLNADJ,
+                f.ParentPLN
+                from f
+                    JOIN vw_trc_PIBID d ON d.IngredientBatchID = f.ProductBatchID
+                """,
+                lvl,
+            ).fetchone()[0]
+            if inserted == 0:
+                break
+    if from_level > 1:
+        con.execute("DELETE FROM tmp_Trc_Results_bid WHERE Level < $from_level", {"from_level": from_level})
+
+    con.execute(
         """
-        CREATE OR REPLACE TEMP VIEW vw_Trc_Results AS
+        CREATE TEMP VIEW IF NOT EXISTS vw_Trc_Results AS
         with
             d
             AS
@@ -285,9 +1386,15 @@ def func_trc_PrBID(level):
                     SLNADJ as SupplierLot,
                     LotLabel,
                     ParentLotLabel
-                from vw_MatTxnsWithItemCodes
+                from mat_txns
+                where BATCH_ID in (
+                    select ProductBatchID from tmp_Trc_Results_bid
+                    union
+                    select IngredientBatchID from tmp_Trc_Results_bid
+                )
                 GROUP BY ALL
-        )ទ
+        )
+            ,
             bid
             as
             (
@@ -337,53 +1444,134 @@ def func_trc_PrBID(level):
         """
     )
 
-def func_gen_PrBID(level):
-    engine.execute(
-        f"""
-        CREATE OR REPLACE TEMP TABLE tmp_Gen_Results_bid AS
-        with recursive
-            pbid
-            as
-            (
-                select ProductBatchID, IngredientBatchID
-                from vw_Gen_PIBID 
-                GROUP BY all
-            ),
-            r
-            as
-            (
-                select
-                    PBID.ProductBatchid,
-                    IngredientBatchID,
-                    1 as Level,
-                    PBID.ProductBatchID as Parent,
-                    C.NodeType
-                from pbid
-                    JOIN tmp_GenForLots C ON PBID.ProductBatchID = C.BATCH_ID
-                where 1=1
-
-            union all
-
+def func_gen_PrBID(con, level, engine="sql", from_level=1):
+    # The links of the root batches are level 1, or from_level for a trace seeded with the
+    # batches that made the frontier lots of a loaded trace.
+    if engine == "closure":
+        run_insert(
+            con,
+            "tmp_Gen_Results_bid",
+            """
+            with
+                pbid
+                as
+                (
+                    select ProductBatchID, IngredientBatchID
+                    from vw_Gen_PIBID 
+                    GROUP BY all
+                )
+            select
+                d.ProductBatchID,
+                d.IngredientBatchID,
+                cl.MinLevel + $from_level as Level,
+                C.BATCH_ID as Parent,
+                C.NodeType
+            from tmp_GenForLots C
+                JOIN closure.BatchClosure cl ON cl.Direction = 'Gen'
+                    AND cl.AncestorBatchID = C.BATCH_ID
+                    AND cl.MinLevel + $from_level <= {level}
+                JOIN pbid d ON d.ProductBatchID = cl.DescendantBatchID
+            group by all
+            """,
+            level,
+            {"from_level": from_level},
+        )
+    elif engine in ("csr", "link"):
+        roots = con.execute("select distinct BATCH_ID from tmp_GenForLots").pl()
+        if engine == "link":
+            targets = con.execute(
+                """
+                select distinct BATCH_ID
+                from mat_txns
+                where TYPE = 'Ingredient'
+                AND LOT_NUMBER in (select Lot_Number from tmp_TraceTarget)
+                """
+            ).pl()
+            walked = get_graph(con).link(
+                "Gen", roots["BATCH_ID"], targets["BATCH_ID"], level, first_level=from_level, include_target_links=True
+            )
+        else:
+            walked = get_graph(con).walk("Gen", roots["BATCH_ID"], level, first_level=from_level)
+        insert_walked(
+            con,
+            "tmp_Gen_Results_bid",
+            walked,
+            """
+            select
+                d.ProductBatchID,
+                d.IngredientBatchID,
+                d.Level,
+                C.BATCH_ID as Parent,
+                C.NodeType
+            from tmp_GenForLots C
+                JOIN walked d ON d.RootBatchID = C.BATCH_ID
+            group by all
+            """,
+        )
+    else:
+        run_insert(
+            con,
+            "tmp_Gen_Results_bid",
+            """
+            select
+                PBID.ProductBatchid,
+                IngredientBatchID,
+                $from_level::INTEGER as Level,
+                PBID.ProductBatchID as Parent,
+                C.NodeType
+            from vw_Gen_PIBID pbid
+                JOIN tmp_GenForLots C ON PBID.ProductBatchID = C.BATCH_ID
+            group by all
+            """,
+            parameters={"from_level": from_level},
+        )
+        # Same level-at-a-time expansion as the trace: only ingredient batches a root reaches
+        # for the first time are expanded further.
+        for lvl in range(from_level, level):
+            inserted = run_insert(
+                con,
+                "tmp_Gen_Results_bid",
+                """
+                with
+                f as
+                (
+                    select IngredientBatchID as BatchID, Parent, NodeType
+                    from tmp_Gen_Results_bid r
+                    where r.Level = {level}
+                    AND r.IngredientBatchID <> r.Parent
+                    AND NOT EXISTS (
+                        select 1 from tmp_Gen_Results_bid v
+                        where v.Level < {level}
+                        AND v.IngredientBatchID = r.IngredientBatchID
+                        AND v.Parent = r.Parent
+                        AND v.NodeType IS NOT DISTINCT FROM r.NodeType
+                    )
+                    GROUP BY ALL
+                )
                 select
                     d.ProductBatchID,
                     d.IngredientBatchID,
-                    r.Level + 1,
-                    r.Parent,
-                    R.NodeType
-                from r, pbid d
-                where 
-                    r.IngredientBatchID = d.ProductBatchID
-                    AND r.level< {level}
-            )
-        select productbatchid, ingredientbatchid, level, parent, NodeType
-        from r
-        group by all;
-    """
-    )
+                    {level} + 1 as Level,
+                    f.Parent,
+                    f.NodeType
+                from f
+                    JOIN vw_Gen_PIBID d ON d.ProductBatchID = f.BatchID
+                group by all
+                """,
+                lvl,
+            ).fetchone()[0]
+            if inserted == 0:
+                break
+
+    create_gen_results_view(con)
 
-    engine.execute(
+def create_gen_results_view(con):
+    """
+    Create the session view vw_Gen_Results over tmp_GenForLots and tmp_Gen_Results_bid.
+    """
+    con.execute(
         """
-        CREATE OR REPLACE TEMP VIEW vw_Gen_Results AS 
+        CREATE TEMP VIEW IF NOT EXISTS vw_Gen_Results AS
         with
             d
             AS
@@ -397,7 +1585,12 @@ def func_gen_PrBID(level):
                 SLNADJ as SupplierLot,
                 LotLabel,
                 ParentLotLabel
-            from vw_MatTxnsWithItemCodes
+            from mat_txns
+            where BATCH_ID in (
+                select ProductBatchID from tmp_Gen_Results_bid
+                union
+                select Parent from tmp_Gen_Results_bid
+            )
             GROUP BY all
             ),
             bid
@@ -451,123 +1644,342 @@ def func_gen_PrBID(level):
         """
     )
 
-def func_Source(input, GenOrTrc, level):
-    varTraceFor = input
+def func_Nodes(con, startNodes, endNodes=None):
+    """
+    Resolve the start and target nodes against material transactions in a single statement.
+
+    Transactions are matched on their lot, parent lot, item code and supplier lot, and each
+    match is kept with the nodetype of the column it matched and the node value it matched,
+    so func_Source and func_Target only filter tmp_NodeMatches by role and transaction type.
+    """
+    bind_nodes(con, "tmp_Nodes", startNodes, "Source")
+    if endNodes is not None:
+        bind_nodes(con, "tmp_Nodes", endNodes, "Target")
+    nodes = sorted(set(normalize_nodes(startNodes)) | set(normalize_nodes(endNodes)))
+
+    # One single-column lookup per node type, with the nodes bound as a list, so that each can
+    # be answered from its ART index on MatTxnsWithItemCodes. DuckDB only scans an index for a
+    # lone equality filter, so OR-ing the four columns, or filtering TYPE here as well, makes
+    # every lookup a scan of the whole table; the readers of tmp_NodeMatches filter TYPE.
+    strNodeMatches = """
+        with
+        k as
+        (
+            select ItemCode, Lot_Number, 'Lot' as nodetype, LOT_NUMBER::VARCHAR as node, TYPE, BATCH_ID
+            from mat_txns where LOT_NUMBER = ANY($nodes)
+            union all
+            select ItemCode, Lot_Number, 'ParentLot', parent_lot_number::VARCHAR, TYPE, BATCH_ID
+            from mat_txns where parent_lot_number = ANY($nodes)
+            union all
+            select ItemCode, Lot_Number, 'Item', ItemCode::VARCHAR, TYPE, BATCH_ID
+            from mat_txns where ItemCode = ANY($nodes)
+            union all
+            select ItemCode, Lot_Number, 'SupplierLot', SUPPLIER_LOT_NUMBER::VARCHAR, TYPE, BATCH_ID
+            from mat_txns where SUPPLIER_LOT_NUMBER = ANY($nodes)
+        )
+        select k.ItemCode, k.Lot_Number, k.nodetype, k.node, k.TYPE, k.BATCH_ID, n.role
+        from k
+            JOIN tmp_Nodes n ON n.node = k.node
+        group by all
+        """
+    run_insert(con, "tmp_NodeMatches", strNodeMatches, parameters={"nodes": nodes})
+
+def func_QueryRoots(con, queryRoots):
+    """
+    Map the lots resolved from each get_lineage_many start set back to the set's root id.
+    """
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_QueryRoots (query_root VARCHAR, node VARCHAR)")
+    con.execute(
+        "INSERT INTO tmp_QueryRoots select unnest(?::VARCHAR[]), unnest(?::VARCHAR[])",
+        [[root for root, _ in queryRoots], [node for _, node in queryRoots]],
+    )
+    strQueryRootLots = """
+        select r.query_root, m.Lot_Number, m.TYPE
+        from tmp_QueryRoots r
+            JOIN tmp_NodeMatches m ON m.node = r.node
+        where m.role = 'Source'
+            AND m.TYPE in ('Ingredient', 'Product')
+            AND NOT (m.TYPE = 'Product' AND m.nodetype = 'SupplierLot')
+        group by all
+        """
+    run_insert(con, "tmp_QueryRootLots", strQueryRootLots)
+
+def func_Source(con, GenOrTrc, level, engine="sql", helper=None, progress=None, from_level=1):
+    """
+    Resolve the source lots of each direction and trace them.
 
-    if GenOrTrc == "trc" or GenOrTrc == "all":
-        strTraceFor = f"""CREATE OR REPLACE TEMP TABLE tmp_TraceForLots AS (
-                    select mt.ItemCode, mt.Lot_Number, 'Lot' as nodetype
-                    from 
-                    vw_MatTxnsWithItemCodes mt
-                    where 1=1 
-                        AND mt.LOT_NUMBER in ('{varTraceFor}')
-                        AND mt.type = 'Ingredient' 
-                    group by mt.ItemCode, mt.Lot_Number
-
-                    union all
-
-                    select mt.ItemCode, mt.Lot_Number,  'ParentLot' as nodetype
-                    from 
-                    vw_MatTxnsWithItemCodes mt
-                    where 1=1 
-                        AND mt.parent_lot_number in ('{varTraceFor}')
-                        AND mt.type = 'Ingredient' 
-                    group by mt.ItemCode, mt.Lot_Number
-
-                    union all
-
-                    select mt.ItemCode,  mt.LOT_NUMBER,  'Item' as nodetype
-                    from vw_MatTxnsWithItemCodes mt
-                    WHERE 1=1 
-                        AND mt.itemcode in ('{varTraceFor}')
-                        AND mt.type = 'Ingredient'
-                    group by mt.ItemCode, mt.Lot_Number
-
-                    union all
-
-                    select mt.ItemCode,  mt.LOT_NUMBER,  'SupplierLot' as nodetype
-                    from 
-                        vw_MatTxnsWithItemCodes mt
-                    WHERE 1=1 
-                        AND mt.TYPE = 'Ingredient'
-                        AND mt.SUPPLIER_LOT_NUMBER in ('{varTraceFor}')
-                    group by mt.ItemCode, mt.Lot_Number)
-            """
-        engine.execute(strTraceFor)
-        func_trc_PrBID(level)  # refresh trace temp tables
+    For 'all' with a `helper`, a second pooled cursor, the two directions run at once: the Gen
+    chain on the helper in trace_executor and the Trc chain on `con`. The helper gets a copy of
+    the resolved nodes first, and its Gen tables are copied back to `con` once both finish, so
+    the result query unions the two directions on `con` as before.
+
+    With a `from_level` above 1 the source lots are the frontier of a loaded trace, see
+    get_lineage_frontier().
+    """
+    if GenOrTrc == "all" and helper is not None:
+        copy_temp_tables(con, helper, ("tmp_NodeMatches", "tmp_TraceTarget"))
+        if progress:
+            progress("tracing Trc")
+            progress("tracing Gen")
+        future = trace_executor.submit(trace_gen, helper, level, engine, from_level)
+        try:
+            trace_trc(con, level, engine, from_level)
+        finally:
+            gen_error = future.exception()  # the helper must be idle before it goes back to the pool
+        if gen_error is not None:
+            raise gen_error
+        copy_temp_tables(helper, con, ("tmp_GenForLots", "tmp_Gen_Results_bid"))
+        create_gen_results_view(con)
+        return
 
+    if GenOrTrc == "trc" or GenOrTrc == "all":
+        if progress:
+            progress("tracing Trc")
+        trace_trc(con, level, engine, from_level)
     if GenOrTrc == "gen" or GenOrTrc == "all":
-        strGenFor = f"""CREATE OR REPLACE TEMP TABLE tmp_GenForLots AS (
-                    select mt.ItemCode,  mt.Lot_Number,  'Lot' as nodetype, BATCH_ID
-                    from 
-                    vw_MatTxnsWithItemCodes mt
-                    where 1=1 
-                        AND mt.LOT_NUMBER in ('{varTraceFor}')
-                        AND mt.type = 'Product' 
-                    group by all
+        if progress:
+            progress("tracing Gen")
+        trace_gen(con, level, engine, from_level)
+
+def trace_trc(con, level, engine="sql", from_level=1):
+    # a frontier lot is expanded from the batch that made it, a root lot from its consumption
+    strTraceFor = f"""
+                select ItemCode, Lot_Number, nodetype, node
+                from tmp_NodeMatches
+                where role = 'Source'
+                    AND TYPE = '{"Product" if from_level > 1 else "Ingredient"}'
+                group by all
+        """
+    run_insert(con, "tmp_TraceForLots", strTraceFor)
+    with STAGE_SECONDS.time(stage="trc"), profile_stage("func_trc_PrBID"):
+        func_trc_PrBID(con, level, engine, from_level)  # refresh trace temp tables
 
-                    union all
+def trace_gen(con, level, engine="sql", from_level=1):
+    strGenFor = """
+                select ItemCode, Lot_Number, nodetype, BATCH_ID, node
+                from tmp_NodeMatches
+                where role = 'Source'
+                    AND TYPE = 'Product'
+                    AND nodetype <> 'SupplierLot'
+                group by all
+        """
+    run_insert(con, "tmp_GenForLots", strGenFor)
+    with STAGE_SECONDS.time(stage="gen"), profile_stage("func_gen_PrBID"):
+        func_gen_PrBID(con, level, engine, from_level)  # refresh gen temp tables
 
-                    select mt.ItemCode,  mt.Lot_Number,  'ParentLot' as nodetype, BATCH_ID
-                    from 
-                    vw_MatTxnsWithItemCodes mt
-                    where 1=1 
-                        AND mt.parent_lot_number in ('{varTraceFor}')
-                        AND mt.type = 'Product' 
-                    group by all
+def copy_temp_tables(source, target, tables):
+    """
+    Append the rows of the session temp tables `tables` that exist on cursor `source` to the
+    same tables on cursor `target`, creating them there when needed.
+    """
+    existing = {
+        name for (name,) in source.execute(
+            "select table_name from duckdb_tables() where temporary and list_contains(?, table_name)",
+            [list(tables)],
+        ).fetchall()
+    }
+    for table in tables:
+        if table not in existing:
+            continue
+        target.register("copied", source.execute(f"select * from {table}").to_arrow_table())
+        try:
+            target.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} AS select * from copied limit 0")
+            target.execute(f"INSERT INTO {table} BY NAME select * from copied")
+        finally:
+            target.unregister("copied")
 
-                    union all
+def func_Target(con):
+    strTraceTarget = """
+        select ItemCode, Lot_Number, nodetype, node
+        from tmp_NodeMatches
+        where role = 'Target'
+            AND TYPE = 'Ingredient'
+        group by all
+        """
+    run_insert(con, "tmp_TraceTarget", strTraceTarget)
 
-                    select mt.ItemCode,  mt.LOT_NUMBER,  'Item' as nodetype, BATCH_ID
-                    from vw_MatTxnsWithItemCodes mt
-                    WHERE 1=1 
-                        AND mt.itemcode in ('{varTraceFor}')
-                        AND mt.type = 'Product'
-                    group by all
+def get_graph(con=None):
+    """
+    Return the in-memory BatchGraph used by engine="csr", loading it on first use.
+
+    Call it once at startup to pay the load cost before the first trace. The graph is
+    reloaded when the database file changes. Callers that already hold a pool session pass
+    its cursor so the load does not wait on the pool. As in get_resident, the load runs outside
+    graph_lock so that waiting for a session never holds up a caller that has one.
+    """
+    global graph
+    version = database_version()
+    with graph_lock:
+        current = graph
+    if current is not None and current.version == version:
+        return current
+    with profile_stage("get_graph"):
+        if con is None:
+            with pool.session() as con:
+                loaded = BatchGraph.load(con)
+        else:
+            loaded = BatchGraph.load(con)
+    loaded.version = version
+    with graph_lock:
+        if graph is None or graph.version != version:
+            graph = loaded
+        return graph
+
+def attach_closure():
+    """
+    Attach the sidecar closure database (read-only) as 'closure', visible to every pooled cursor.
+    """
+    if not os.path.exists(CLOSURE_URL):
+        raise FileNotFoundError(
+            f"Closure table {CLOSURE_URL} not found. Build it with `python Lineage.py build-closure`."
+        )
+    connection.execute(f"ATTACH IF NOT EXISTS '{CLOSURE_URL}' AS closure (READ_ONLY)")
+
+def build_closure(database_url=DATABASE_URL, closure_url=CLOSURE_URL, max_level=99):
+    """
+    Materialize the batch transitive closure of vw_Gen_PIBID and vw_trc_PIBID into a sidecar DuckDB file.
+
+    Each row of BatchClosure says DescendantBatchID is reachable from AncestorBatchID in MinLevel
+    steps walking in Direction: 'Gen' follows ProductBatchID -> IngredientBatchID, 'Trc' follows
+    IngredientBatchID -> ProductBatchID. Every batch also reaches itself at MinLevel 0, so the
+    trace queries can join the root batches straight onto the closure.
+
+    The closure is expanded one level at a time, keeping only pairs not seen at a lower level.
+    It is written to a temporary file first and swapped in when complete, so a running app
+    never sees a half-built table.
+
+    Args:
+        database_url (str): Path to the lineage database to read the batch links from.
+        closure_url (str): Path of the sidecar closure database to (re)create.
+        max_level (int): Deepest level to expand, matching the trace queries' limit.
+    """
+    tmp_url = closure_url + ".tmp"
+    if os.path.exists(tmp_url):
+        os.remove(tmp_url)
+
+    build = duckdb.connect(tmp_url)
+    try:
+        build.execute(f"ATTACH '{database_url}' AS src (READ_ONLY)")
+        edges = {
+            "Gen": """select ProductBatchID as Src, IngredientBatchID as Dst
+                      from src.vw_Gen_PIBID""",
+            "Trc": """select IngredientBatchID as Src, ProductBatchID as Dst
+                      from src.vw_trc_PIBID""",
+        }
+        for direction, edge_query in edges.items():
+            build.execute(
+                f"""
+                CREATE OR REPLACE TEMP TABLE edges AS
+                select Src, Dst from ({edge_query}) e
+                where Src is not null and Dst is not null
+                group by all
+                """
+            )
+            build.execute(
+                f"""
+                CREATE OR REPLACE TEMP TABLE reach AS
+                select b as AncestorBatchID, b as DescendantBatchID, 0 as MinLevel
+                from (
+                    select Src as b from ({edge_query}) e
+                    union
+                    select Dst as b from ({edge_query}) e
+                ) n
+                where b is not null
+                """
+            )
+            build.execute("CREATE OR REPLACE TEMP TABLE frontier AS select * from reach")
+
+            for lvl in range(1, max_level + 1):
+                build.execute(
+                    f"""
+                    CREATE OR REPLACE TEMP TABLE frontier AS
+                    select f.AncestorBatchID, e.Dst as DescendantBatchID, {lvl} as MinLevel
+                    from frontier f
+                        JOIN edges e ON e.Src = f.DescendantBatchID
+                    where NOT EXISTS (
+                        select 1 from reach r
+                        where r.AncestorBatchID = f.AncestorBatchID
+                        AND r.DescendantBatchID = e.Dst
                     )
+                    group by all
+                    """
+                )
+                if build.execute("select count(*) from frontier").fetchone()[0] == 0:
+                    break
+                build.execute("INSERT INTO reach select * from frontier")
+
+            build.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS BatchClosure AS
+                select *, '{direction}' as Direction from reach limit 0
+                """
+            )
+            build.execute(
+                f"""
+                INSERT INTO BatchClosure
+                select *, '{direction}' as Direction from reach
+                order by AncestorBatchID, MinLevel
+                """
+            )
+
+        build.execute("CREATE INDEX idx_BatchClosure_Ancestor ON BatchClosure (Direction, AncestorBatchID)")
+        build.execute("DETACH src")
+    finally:
+        build.close()
+
+    os.replace(tmp_url, closure_url)
+
+def refresh_mat_txns(database_url=DATABASE_URL):
+    """
+    Materialize vw_MatTxnsWithItemCodes into the indexed table MatTxnsWithItemCodes.
+
+    The trace queries look material transactions up by lot, parent lot, item code, supplier lot
+    and batch, and each request used to evaluate the view for every lookup. The table holds the
+    view's rows once, sorted by batch so that batch lookups skip row groups by their min/max,
+    with ART indexes for func_Nodes' single-column node lookups. Run it after every load of the
+    database, while the app is stopped, since the table is not kept in sync with the view.
+
+    Args:
+        database_url (str): Path to the lineage database to refresh.
+    """
+    refresh = duckdb.connect(database_url)
+    try:
+        refresh.execute("BEGIN TRANSACTION")
+        refresh.execute(
+            f"""
+            CREATE OR REPLACE TABLE {MAT_TXNS_TABLE} AS
+            select * from vw_MatTxnsWithItemCodes
+            order by BATCH_ID, TYPE
             """
-        engine.execute(strGenFor)
-        func_gen_PrBID(level)  # refresh gen temp tables
-
-def func_Target(input):
-    varTraceTarget = input
-
-    strTraceTarget = f"""CREATE OR REPLACE TEMP TABLE tmp_TraceTarget AS (
-        select mt.ItemCode,  mt.Lot_Number,  'Lot' as nodetype
-        from 
-        vw_MatTxnsWithItemCodes mt
-        where 1=1 
-            AND mt.LOT_NUMBER in ('{varTraceTarget}')
-            AND mt.type = 'Ingredient' 
-        group by mt.ItemCode, mt.Lot_Number
-
-        union all
-
-        select mt.ItemCode,  mt.Lot_Number,  'ParentLot' as nodetype
-        from 
-        vw_MatTxnsWithItemCodes mt
-        where 1=1 
-            AND mt.parent_lot_number in ('{varTraceTarget}')
-            AND mt.type = 'Ingredient' 
-        group by mt.ItemCode, mt.Lot_Number
-
-        union all
-
-        select mt.ItemCode,  mt.LOT_NUMBER,  'Item' as nodetype
-        from vw_MatTxnsWithItemCodes mt
-        WHERE 1=1 
-            AND mt.itemcode in ('{varTraceTarget}')
-            AND mt.type = 'Ingredient'
-        group by mt.ItemCode, mt.Lot_Number
-
-        union all
-
-        select mt.ItemCode,  mt.LOT_NUMBER,  'SupplierLot' as nodetype
-        from 
-            vw_MatTxnsWithItemCodes mt
-        WHERE 1=1 
-            AND mt.TYPE = 'Ingredient'
-            AND mt.SUPPLIER_LOT_NUMBER in ('{varTraceTarget}')
-        group by mt.ItemCode, mt.Lot_Number)
-        """
-    engine.execute(strTraceTarget)
+        )
+        for name, column in (
+            ("Lot", "LOT_NUMBER"),
+            ("ParentLot", "parent_lot_number"),
+            ("Item", "ItemCode"),
+            ("SupplierLot", "SUPPLIER_LOT_NUMBER"),
+        ):
+            refresh.execute(f"CREATE INDEX idx_{MAT_TXNS_TABLE}_{name} ON {MAT_TXNS_TABLE} ({column})")
+        refresh.execute("COMMIT")
+    finally:
+        refresh.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline maintenance for the lineage database.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    closure_parser = sub.add_parser("build-closure", help="Rebuild the batch closure sidecar database.")
+    closure_parser.add_argument("--database", default=DATABASE_URL)
+    closure_parser.add_argument("--output", default=CLOSURE_URL)
+    closure_parser.add_argument("--max-level", type=int, default=99)
+    refresh_parser = sub.add_parser(
+        "refresh-mat-txns", help="Rebuild the indexed material transactions table."
+    )
+    refresh_parser.add_argument("--database", default=DATABASE_URL)
+    args = parser.parse_args()
+
+    if args.command == "build-closure":
+        build_closure(args.database, args.output, args.max_level)
+    elif args.command == "refresh-mat-txns":
+        connection.close()  # the module's read-only handle would block opening the file for writing
+        refresh_mat_txns(args.database)
@@ -0,0 +1,193 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ["Counter", "Gauge", "Histogram", "render", "dump", "merge", "STAGE_SECONDS", "PAYLOAD_BYTES", "ROWS_RETURNED",
+           "REQUESTS", "REQUESTS_IN_FLIGHT", "CACHE_REQUESTS"]
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KiB .. 1 GiB
+
+registry = []
+registry_lock = threading.Lock()
+
+class Metric:
+    """
+    Base of the process-wide metrics exposed in Prometheus text format by render().
+
+    Values are kept per label set, a sorted tuple of (name, value) pairs, so one metric covers
+    e.g. every trace stage. All updates take the metric's lock and are safe across threads.
+    """
+
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+        with registry_lock:
+            registry.append(self)
+
+    def samples(self):
+        """
+        (suffix, labels, value) for every sample line of the metric.
+        """
+        with self._lock:
+            return [("", labels, value) for labels, value in self._values.items()]
+
+    def values(self, reset=False) -> list:
+        """
+        (labels, value) pairs of the metric, cleared as they are taken with reset=True.
+        """
+        with self._lock:
+            values = list(self._values.items())
+            if reset:
+                self._values = {}
+            return values
+
+    def merge(self, values):
+        """
+        Add (labels, value) pairs taken by values() in another process.
+        """
+        with self._lock:
+            for labels, value in values:
+                key = tuple(tuple(label) for label in labels)
+                self._values[key] = self._values.get(key, 0) + value
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Count the block as in progress while it runs.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def values(self, reset=False) -> list:
+        with self._lock:
+            values = [(labels, (list(counts), total)) for labels, (counts, total) in self._values.items()]
+            if reset:
+                self._values = {}
+            return values
+
+    def merge(self, values):
+        with self._lock:
+            for labels, (counts, total) in values:
+                key = tuple(tuple(label) for label in labels)
+                old_counts, old_total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+                self._values[key] = ([a + b for a, b in zip(old_counts, counts)], old_total + total)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the wall-clock seconds the block takes, also when it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append(("_bucket", labels + (("le", le),), cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def dump(reset=False) -> dict:
+    """
+    The values of every registered metric by name, to merge() into another process' metrics.
+    With reset=True they are cleared as they are taken, so a long-lived worker process hands
+    over only what it recorded since its last dump.
+    """
+    with registry_lock:
+        metrics = list(registry)
+    return {metric.name: metric.values(reset) for metric in metrics}
+
+def merge(values: dict):
+    """
+    Add a dump() taken in another process, e.g. a background callback job, to this process'
+    metrics. Metrics this process does not register are ignored.
+    """
+    with registry_lock:
+        metrics = {metric.name: metric for metric in registry}
+    for name, metric_values in values.items():
+        if name in metrics:
+            metrics[name].merge(metric_values)
+
+def render() -> str:
+    """
+    All registered metrics in the Prometheus text exposition format.
+    """
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            label_text = ",".join(f'{name}="{escape_label(label)}"' for name, label in labels)
+            lines.append(f"{metric.name}{suffix}{{{label_text}}} {value}" if labels else f"{metric.name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram(
+    "lineage_stage_seconds",
+    "Wall-clock seconds spent per lineage stage (node_resolution, trc, gen, result_select, ...).",
+)
+PAYLOAD_BYTES = Histogram(
+    "lineage_callback_payload_bytes",
+    "Size in bytes of Dash callback responses, per callback output.",
+    buckets=SIZE_BUCKETS,
+)
+ROWS_RETURNED = Counter("lineage_rows_returned_total", "Rows returned by get_lineage.")
+REQUESTS = Counter("lineage_requests_total", "get_lineage requests, by engine.")
+REQUESTS_IN_FLIGHT = Gauge("lineage_requests_in_flight", "get_lineage requests currently holding a database session.")
+CACHE_REQUESTS = Counter("lineage_cache_requests_total", "get_lineage result cache lookups, by result (hit or miss).")
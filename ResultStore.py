@@ -0,0 +1,203 @@
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import duckdb
+import polars as pl
+
+__all__ = ["ResultStore"]
+
+QUERY_ID = re.compile(r"^[0-9a-f]{32}$")
+
+# Filter operators of rows(), each applied to a column's value as lowercased text, except 'in',
+# which matches the exact text of one of a list of values
+FILTER_SQL = {
+    "contains": "contains({value}, lower(?))",
+    "notContains": "NOT contains({value}, lower(?))",
+    "equals": "{value} = lower(?)",
+    "notEqual": "{value} <> lower(?)",
+    "startsWith": "starts_with({value}, lower(?))",
+    "endsWith": "ends_with({value}, lower(?))",
+    "in": "list_contains(?::VARCHAR[], {text})",
+}
+
+class ResultStore:
+    """
+    Server-side store of Submit results, so the browser only holds their query id.
+
+    Every result is written through to `directory` as one Parquet file per frame name under the
+    query id, which makes it readable from any process: Submit runs in a background job
+    process, the callbacks reading the result in the server. Frames read or written in this
+    process are kept in a thread-safe LRU bounded by their total size in bytes. Results older
+    than `max_age` seconds are deleted when new ones are stored, and a result whose directory
+    is gone is never served from the LRU.
+
+    Pages of a stored frame are served by rows(), which filters, sorts and slices the Parquet
+    file in DuckDB, so only the requested rows are ever materialized.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, max_age=24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._connection = duckdb.connect()
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, frames: dict) -> str:
+        """
+        Store named frames under a new query id and return the id.
+        """
+        self.prune()
+        query_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, query_id)
+        tmp_path = f"{path}.tmp"
+        os.makedirs(tmp_path)
+        for name, frame in frames.items():
+            frame.write_parquet(os.path.join(tmp_path, f"{name}.parquet"))
+            self._remember((query_id, name), frame)
+        os.replace(tmp_path, path)  # readers never see a partly written result
+        return query_id
+
+    def get(self, query_id, name) -> pl.DataFrame | None:
+        """
+        The frame `name` of a stored result, None when the id is unknown or has expired.
+        """
+        if not query_id or not QUERY_ID.match(str(query_id)):
+            return None
+        if not os.path.isdir(os.path.join(self.directory, query_id)):
+            self._forget(query_id)  # pruned, possibly by another process
+            return None
+        key = (query_id, name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+        path = os.path.join(self.directory, query_id, f"{name}.parquet")
+        if not os.path.exists(path):
+            return None
+        frame = pl.read_parquet(path)
+        self._remember(key, frame)
+        return frame
+
+    def path(self, query_id, name) -> str | None:
+        """
+        The Parquet file of frame `name` of a stored result, None when it does not exist.
+        """
+        if not query_id or not QUERY_ID.match(str(query_id)):
+            return None
+        path = os.path.join(self.directory, query_id, f"{name}.parquet")
+        return path if os.path.exists(path) else None
+
+    def rows(self, query_id, name, start, end, sort=(), filters=()):
+        """
+        One page of a stored frame, read with LIMIT/OFFSET after filtering and sorting in SQL.
+
+        Args:
+            query_id (str): Id returned by put().
+            name (str): Frame name within the result.
+            start (int): First row of the page.
+            end (int): Row after the last row of the page.
+            sort (list): (column, descending) pairs, in order of precedence. Ties keep the
+                stored row order, so pages never overlap.
+            filters (list): Groups of (column, operator, value) conditions of FILTER_SQL. A row
+                passes when it meets at least one condition of every group.
+
+        Returns:
+            tuple: The page as a list of row dicts, and the number of rows passing the filters.
+        """
+        path = self.path(query_id, name)
+        if path is None:
+            return [], 0
+        where, params = self._where(path, filters)
+        columns = pl.read_parquet_schema(path)
+        order = [f'"{column}" {"desc" if descending else "asc"}' for column, descending in sort if column in columns]
+        order = ", ".join(order + ["file_row_number"])
+        con = self._connection.cursor()
+        try:
+            total = con.execute(f"select count(*) from read_parquet(?) where {where}", [path, *params]).fetchone()[0]
+            page = con.execute(
+                f"""
+                select * exclude (file_row_number)
+                from read_parquet(?, file_row_number = true)
+                where {where}
+                order by {order}
+                limit ? offset ?
+                """,
+                [path, *params, max(0, end - start), max(0, start)],
+            ).pl()
+        finally:
+            con.close()
+        return page.to_dicts(), total
+
+    def filtered(self, query_id, name, filters=()) -> pl.DataFrame | None:
+        """
+        All rows of a stored frame passing `filters`, in stored order, as for rows().
+        """
+        path = self.path(query_id, name)
+        if path is None:
+            return None
+        where, params = self._where(path, filters)
+        con = self._connection.cursor()
+        try:
+            return con.execute(
+                f"""
+                select * exclude (file_row_number)
+                from read_parquet(?, file_row_number = true)
+                where {where}
+                order by file_row_number
+                """,
+                [path, *params],
+            ).pl()
+        finally:
+            con.close()
+
+    def _where(self, path, filters):
+        columns = pl.read_parquet_schema(path)
+        clauses, params = [], []
+        for group in filters:
+            conditions = []
+            for column, operator, value in group:
+                if column not in columns or operator not in FILTER_SQL:
+                    continue
+                text = f"coalesce(CAST(\"{column}\" AS VARCHAR), '')"
+                conditions.append(FILTER_SQL[operator].format(value=f"lower({text})", text=text))
+                params.append([str(v) for v in value] if operator == "in" else str(value))
+            if conditions:
+                clauses.append("(" + " OR ".join(conditions) + ")")
+        return " AND ".join(clauses) or "true", params
+
+    def prune(self):
+        """
+        Delete the results older than max_age, on disk and from the in-memory LRU.
+        """
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                self._forget(entry.name)
+
+    def _forget(self, query_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == query_id]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def _remember(self, key, frame: pl.DataFrame):
+        size = frame.estimated_size()
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (frame, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
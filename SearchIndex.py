@@ -0,0 +1,108 @@
+import numpy as np
+import polars as pl
+
+__all__ = ["SearchIndex"]
+
+class SearchIndex:
+    """
+    Memory-resident typeahead index over a set of codes, matched case-insensitively.
+
+    Codes are numbered in the sorted order of their lowercased keys, so every code starting with
+    a search term is one contiguous id range found by binary search. Substring matches come from
+    trigram postings: for each three-character gram, the sorted ids of the codes containing it,
+    stored back to back in one array with per-gram offsets. A search intersects the postings of
+    the term's grams and confirms the candidates. Codes shorter than a trigram are checked
+    directly.
+
+    Results are ranked exact match first, then prefix matches, then other substring matches,
+    each group in key order, and capped at `limit`.
+    """
+
+    def __init__(self, values: pl.Series, labels: pl.Series):
+        keys = values.str.to_lowercase()
+        order = keys.arg_sort()
+        self.keys = keys.gather(order).to_numpy()
+        self.values = values.gather(order).to_numpy()
+        self.labels = labels.gather(order).to_numpy()
+        self.version = None
+
+        frame = pl.DataFrame({"key": self.keys}).with_row_index("id").with_columns(
+            pl.col("key").str.len_chars().alias("length")
+        )
+        self.short_ids = frame.filter(pl.col("length") < 3)["id"].to_numpy()
+        # ids come out of the explode in ascending order and the per-gram aggregation keeps it
+        grams = (
+            frame.filter(pl.col("length") >= 3)
+            .with_columns(pl.int_ranges(0, pl.col("length") - 2).alias("pos"))
+            .explode("pos")
+            .group_by(pl.col("key").str.slice(pl.col("pos"), 3).alias("gram"))
+            .agg(pl.col("id").unique(maintain_order=True))
+            .with_columns(pl.col("id").list.len().alias("len"))
+        )
+        ends = np.cumsum(grams["len"].to_numpy())
+        starts = ends - grams["len"].to_numpy()
+        self.postings_ids = grams["id"].explode().to_numpy()
+        self.postings = dict(zip(grams["gram"].to_list(), zip(starts.tolist(), ends.tolist())))
+
+    @classmethod
+    def from_frame(cls, frame: pl.DataFrame, value="value", label="label"):
+        """
+        Build the index from the distinct, non-null `value` codes of a frame and their labels.
+        """
+        frame = frame.filter(pl.col(value).is_not_null()).unique(value)
+        return cls(frame[value], frame[label])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, term, limit=100):
+        """
+        Ids of the codes containing `term`, best matches first, at most `limit` of them (all of
+        them when `limit` is None).
+        """
+        if limit is None:
+            limit = len(self.keys)
+        term = (term or "").strip().lower()
+        if not term:
+            return np.arange(min(limit, len(self.keys)))
+
+        lo = np.searchsorted(self.keys, term, "left")
+        hi = np.searchsorted(self.keys, term + "\uffff", "left")
+        hits = list(range(lo, min(hi, lo + limit)))
+        if len(hits) < limit:
+            for i in self._substring_ids(term, limit - len(hits) + (hi - lo)):
+                if (i < lo or i >= hi) and term in self.keys[i]:
+                    hits.append(i)
+                    if len(hits) == limit:
+                        break
+        return np.asarray(hits, dtype=np.int64)
+
+    def options(self, term, limit=100) -> list[dict]:
+        """
+        Dropdown options ('label' and 'value') for the codes matching `term`.
+        """
+        return [
+            {"label": self.labels[i], "value": self.values[i]}
+            for i in self.search(term, limit)
+        ]
+
+    def _posting(self, gram):
+        start, end = self.postings.get(gram, (0, 0))
+        return self.postings_ids[start:end]
+
+    def _substring_ids(self, term, limit):
+        """
+        Sorted candidate ids for a substring search, a superset of the first `limit` matches.
+        """
+        if len(term) >= 3:
+            grams = sorted({term[i:i + 3] for i in range(len(term) - 2)}, key=lambda g: len(self._posting(g)))
+            ids = self._posting(grams[0])
+            for gram in grams[1:]:
+                if len(ids) == 0:
+                    break
+                ids = np.intersect1d(ids, self._posting(gram), assume_unique=True)
+            return ids
+        # A short term can sit in any gram containing it. The first `limit` matches overall are
+        # each among the first `limit` ids of one of those postings.
+        parts = [self._posting(gram)[:limit] for gram in self.postings if term in gram]
+        return np.unique(np.concatenate(parts + [self.short_ids]))
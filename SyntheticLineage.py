@@ -0,0 +1,180 @@
+import os
+import random
+
+import duckdb
+import pyarrow as pa
+
+__all__ = ["generate", "SIZES"]
+
+# Named scales for the benchmark runner, keyword arguments of generate()
+SIZES = {
+    "small": dict(items=200, lots=250, batches=2_000, depth=8, fan_in=3, fan_out=2, bags=3),
+    "medium": dict(items=2_000, lots=2_500, batches=20_000, depth=12, fan_in=4, fan_out=2, bags=3),
+    "large": dict(items=20_000, lots=25_000, batches=200_000, depth=16, fan_in=5, fan_out=3, bags=4),
+}
+
+def generate(
+    path,
+    items=200,
+    lots=250,
+    batches=2_000,
+    depth=8,
+    fan_in=3,
+    fan_out=2,
+    bags=3,
+    reconvergence=0.2,
+    seed=42,
+):
+    """
+    Build a synthetic genealogy database with the tables and views Lineage.py reads.
+
+    Items are spread over depth + 1 process layers. Layer 0 holds the raw materials, received as
+    `lots` supplier lots; each of the `batches` production batches makes one item of a higher
+    layer as `bags` individual lots under one parent lot, and consumes `fan_in` lots of the layer
+    below. With probability `reconvergence` an ingredient comes from an older layer instead, so
+    paths of different lengths meet at one batch. Every lot is consumed by up to `fan_out`
+    batches before lots of its layer are reused at random.
+
+    The tables are ItemMaster, MaterialTransactions and BatchLinks, with the views
+    vw_MatTxnsWithItemCodes, vw_trc_PIBID, vw_Gen_PIBID and vw_ListOfTypes on top. Run
+    `python Lineage.py refresh-mat-txns` and `python Lineage.py build-closure` against the file,
+    with LINEAGE_DATABASE_URL pointing at it, to add the derived tables.
+
+    Args:
+        path (str): DuckDB file to (re)create.
+        items (int): Number of ItemMaster items.
+        lots (int): Number of received raw material parent lots.
+        batches (int): Number of production batches.
+        depth (int): Number of process layers above the raw materials.
+        fan_in (int): Ingredient lots consumed per batch.
+        fan_out (int): Batches consuming each lot before lots are reused.
+        bags (int): Individual lots per parent lot.
+        reconvergence (float): Probability of an ingredient skipping back to an older layer.
+        seed (int): Random seed, the same arguments always build the same database.
+    """
+    rng = random.Random(seed)
+    depth = max(1, depth)
+    product_codes = max(1, items // 5)
+
+    item_cols = {"ItemCode": [], "Category": [], "ProductCode": [], "Description": [], "UnitOpName": [], "tag": []}
+    layer_items = [[] for _ in range(depth + 1)]
+    for n in range(max(items, depth + 1)):
+        layer = n % (depth + 1)
+        code = f"I{n:06d}"
+        layer_items[layer].append(code)
+        item_cols["ItemCode"].append(code)
+        item_cols["Category"].append("Raw" if layer == 0 else "Intermediate")
+        item_cols["ProductCode"].append(f"P{n % product_codes:05d}")
+        item_cols["Description"].append(f"Item {n} description " + "x" * 40)
+        item_cols["UnitOpName"].append(f"UnitOp {layer}")
+        item_cols["tag"].append(f"T{layer}")
+
+    txn_names = ["BATCH_ID", "TYPE", "ItemCode", "LOT_NUMBER", "parent_lot_number",
+                 "SUPPLIER_LOT_NUMBER", "SLNADJ", "LotLabel", "ParentLotLabel"]
+    link_names = ["ProductBatchID", "IngredientBatchID", "ItemCode", "Lot_Number", "Type", "SLNADJ", "PLN"]
+    txns = {name: [] for name in txn_names}
+    links = {name: [] for name in link_names}
+
+    # per layer: every lot as (item, lot, parent lot, supplier lot, producing batch), and the
+    # pool of lots still to be consumed, each lot in it fan_out times
+    layer_lots = [[] for _ in range(depth + 1)]
+    pools = [[] for _ in range(depth + 1)]
+
+    def add_lot(layer, lot):
+        layer_lots[layer].append(lot)
+        pools[layer].extend([lot] * max(1, fan_out))
+
+    def take_lot(layer):
+        pool = pools[layer]
+        if not pool:
+            return rng.choice(layer_lots[layer])
+        i = rng.randrange(len(pool))
+        pool[i], pool[-1] = pool[-1], pool[i]
+        return pool.pop()
+
+    for n in range(max(1, lots)):
+        item = rng.choice(layer_items[0])
+        pln = f"R{n:07d}"
+        for b in range(bags):
+            add_lot(0, (item, f"{pln}-{b:02d}", pln, f"S{n:07d}", None))
+
+    per_layer = max(1, batches // depth)
+    batch_id = 0
+    for layer in range(1, depth + 1):
+        produced = []
+        for _ in range(per_layer):
+            batch_id += 1
+            item = rng.choice(layer_items[layer])
+            pln = f"L{batch_id:07d}"
+            for b in range(bags):
+                lot = f"{pln}-{b:02d}"
+                produced.append((item, lot, pln, None, batch_id))
+                for name, value in zip(txn_names, (batch_id, "Product", item, lot, pln, None, None, lot, pln)):
+                    txns[name].append(value)
+            for _ in range(fan_in):
+                src = layer - 1
+                if src > 0 and rng.random() < reconvergence:
+                    src = rng.randrange(0, src)
+                ing_item, ing_lot, ing_pln, supplier, ing_batch = take_lot(src)
+                txn = (batch_id, "Ingredient", ing_item, ing_lot, ing_pln, supplier, supplier, ing_lot, ing_pln)
+                for name, value in zip(txn_names, txn):
+                    txns[name].append(value)
+                link = (batch_id, ing_batch, ing_item, ing_lot, "Ingredient", supplier, ing_pln)
+                for name, value in zip(link_names, link):
+                    links[name].append(value)
+        # lots only become ingredients once their whole layer is produced
+        for lot in produced:
+            add_lot(layer, lot)
+
+    if os.path.exists(path):
+        os.remove(path)
+    con = duckdb.connect(path)
+    try:
+        con.register("item_master", pa.table(item_cols))
+        con.register("txns", pa.table({
+            name: pa.array(values, pa.int64() if name == "BATCH_ID" else pa.string())
+            for name, values in txns.items()
+        }))
+        con.register("links", pa.table({
+            name: pa.array(values, pa.int64() if name.endswith("BatchID") else pa.string())
+            for name, values in links.items()
+        }))
+        con.execute("CREATE TABLE ItemMaster AS select * from item_master")
+        con.execute("CREATE TABLE MaterialTransactions AS select *, parent_lot_number as PLN from txns")
+        con.execute("CREATE TABLE BatchLinks AS select * from links")
+        con.execute("CREATE VIEW vw_MatTxnsWithItemCodes AS select * from MaterialTransactions")
+        con.execute("CREATE VIEW vw_trc_PIBID AS select * from BatchLinks")
+        con.execute("CREATE VIEW vw_Gen_PIBID AS select ProductBatchID, IngredientBatchID from BatchLinks")
+        con.execute(
+            """
+            CREATE VIEW vw_ListOfTypes AS
+            select distinct ItemCode as ITEMCODE from MaterialTransactions
+            union select distinct LOT_NUMBER from MaterialTransactions
+            union select distinct parent_lot_number from MaterialTransactions
+            """
+        )
+    finally:
+        con.close()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build a synthetic lineage database.")
+    parser.add_argument("path")
+    parser.add_argument("--size", choices=sorted(SIZES), help="Start from a named scale.")
+    parser.add_argument("--items", type=int)
+    parser.add_argument("--lots", type=int)
+    parser.add_argument("--batches", type=int)
+    parser.add_argument("--depth", type=int)
+    parser.add_argument("--fan-in", type=int)
+    parser.add_argument("--fan-out", type=int)
+    parser.add_argument("--bags", type=int)
+    parser.add_argument("--reconvergence", type=float)
+    parser.add_argument("--seed", type=int)
+    args = vars(parser.parse_args())
+
+    path = args.pop("path")
+    size = args.pop("size")
+    options = dict(SIZES[size]) if size else {}
+    options.update({name: value for name, value in args.items() if value is not None})
+    generate(path, **options)
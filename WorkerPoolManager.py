@@ -0,0 +1,173 @@
+import os
+import queue
+import threading
+import time
+import uuid
+
+import multiprocess
+import psutil
+from dash import DiskcacheManager
+
+__all__ = ["WorkerPoolManager", "cancel_token"]
+
+JOB_POLL_SECONDS = 0.1
+JOB_STATE_EXPIRE = 24 * 3600
+
+_cancel = None  # cancellation token of the job running in this worker process
+
+def cancel_token():
+    """
+    The threading.Event that is set when the job running in this worker process is cancelled,
+    for get_lineage(cancel=...). None outside a WorkerPoolManager job.
+    """
+    return _cancel
+
+def state_key(job):
+    return f"worker-pool-job-{job}"
+
+def cancel_key(job):
+    return f"worker-pool-cancel-{job}"
+
+def worker_key(pid):
+    return f"worker-pool-worker-{pid}"
+
+class WorkerPoolManager(DiskcacheManager):
+    """
+    Dash background callback manager that runs jobs in a fixed set of long-lived worker processes.
+
+    DiskcacheManager starts a new process for every job, which pays the interpreter start and
+    rebuilds everything the app keeps in process (result cache, resident ItemMaster, batch graph)
+    on every Submit. Here `workers` processes are spawned once, on the first job or by start(),
+    and take jobs from a shared queue, so that state survives between jobs. They are spawned
+    rather than forked: a fork inherits the server's polars and DuckDB thread pools mid-flight
+    and can deadlock on their locks.
+
+    Results and progress go through the diskcache as with DiskcacheManager, and so does the job
+    state, so any server process can poll a job. Cancelling a job sets a flag in the cache that
+    the worker passes on to the job's cancel_token(). A job still running `grace` seconds later
+    has its worker killed and replaced.
+
+    Dash has no public hook for running a job elsewhere, so call_job_fn() hands the worker the
+    same job function arguments DiskcacheManager passes its process, including the progress
+    key from the manager's _make_progress_key(), which get_progress() reads back. Both are
+    internal to Dash, which is why requirements.txt pins the Dash release this was built on.
+    """
+
+    def __init__(self, cache, workers=2, grace=5.0, initializer=None, **kwargs):
+        super().__init__(cache, **kwargs)
+        self.workers = workers
+        self.grace = grace
+        self.initializer = initializer
+        self._context = multiprocess.get_context("spawn")
+        self._jobs = None
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Spawn the worker processes and their supervisor, unless they are running.
+        """
+        with self._lock:
+            if self._jobs is not None:
+                return
+            self._jobs = self._context.Queue()
+            self._processes = [self._spawn() for _ in range(self.workers)]
+        threading.Thread(target=self._supervise, name="worker-pool-supervisor", daemon=True).start()
+
+    def call_job_fn(self, key, job_fn, args, context):
+        self.start()
+        job = uuid.uuid4().hex
+        self.handle.set(state_key(job), "queued", expire=JOB_STATE_EXPIRE)
+        # job_fn(result_key, progress_key, args, context), as DiskcacheManager.call_job_fn calls it
+        self._jobs.put((job, job_fn, key, self._make_progress_key(key), args, context))
+        return job
+
+    def job_running(self, job):
+        if job is None:
+            return False
+        state = self.handle.get(state_key(job))
+        return state == "queued" or (state is not None and psutil.pid_exists(state))
+
+    def terminate_job(self, job):
+        if job is not None and self.handle.get(state_key(job)) is not None:
+            self.handle.set(cancel_key(job), time.time(), expire=JOB_STATE_EXPIRE)
+
+    def terminate_unhealthy_job(self, job):
+        if job is not None and self.handle.get(state_key(job)) is not None and not self.job_running(job):
+            self.handle.delete(state_key(job))
+            return True
+        return False
+
+    def _spawn(self):
+        process = self._context.Process(
+            target=work, args=(self._jobs, self.handle, self.initializer, os.getpid()), name="worker-pool", daemon=True
+        )
+        process.start()
+        return process
+
+    def _supervise(self):
+        """
+        Kill workers whose job ignores its cancellation past the grace period, and replace
+        workers that died.
+        """
+        while True:
+            time.sleep(JOB_POLL_SECONDS * 5)
+            with self._lock:
+                for i, process in enumerate(self._processes):
+                    job = self.handle.get(worker_key(process.pid))
+                    if job is not None and process.is_alive():
+                        cancelled = self.handle.get(cancel_key(job))
+                        if cancelled is not None and time.time() - cancelled > self.grace:
+                            process.kill()
+                            process.join(1)
+                    if not process.is_alive():
+                        if job is not None:
+                            self.handle.delete(state_key(job))
+                        self.handle.delete(worker_key(process.pid))
+                        self._processes[i] = self._spawn()
+
+def work(jobs, cache, initializer, parent):
+    """
+    Worker process loop: run the queued jobs one at a time, until a None job arrives or the
+    server process `parent` is gone.
+    """
+    global _cancel
+    if initializer is not None:
+        initializer()
+    pid = os.getpid()
+    while True:
+        try:
+            item = jobs.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent:
+                return
+            continue
+        if item is None:
+            return
+        job, job_fn, key, progress_key, args, context = item
+        if cache.get(cancel_key(job)) is not None:  # cancelled while queued
+            cache.delete(state_key(job))
+            continue
+        cache.set(state_key(job), pid, expire=JOB_STATE_EXPIRE)
+        cache.set(worker_key(pid), job, expire=JOB_STATE_EXPIRE)
+        _cancel, done = threading.Event(), threading.Event()
+        watcher = threading.Thread(target=watch, args=(cache, job, _cancel, done), daemon=True)
+        watcher.start()
+        try:
+            job_fn(key, progress_key, args, context)
+        finally:
+            done.set()
+            watcher.join()
+            _cancel = None
+            cache.delete(worker_key(pid))
+            cache.delete(state_key(job))
+            cache.delete(cancel_key(job))
+
+def watch(cache, job, cancel, done):
+    """
+    Set `cancel` once the job is flagged as cancelled in the cache, until `done` is set.
+    """
+    while not done.wait(JOB_POLL_SECONDS):
+        if cache.get(cancel_key(job)) is not None:
+            cancel.set()
+            return
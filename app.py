@@ -3,7 +3,9 @@ from dash import dcc, html, Input, Output, callback, State, clientside_callback,
 from dash_echarts import DashECharts
 import dash_ag_grid as dag
 import pandas as pd
-from Lineage import get_item_codes, get_lineage, get_product_codes, get_item_to_product_mapping
+from Lineage import (
+    get_item_codes, get_lineage, get_product_codes, get_item_to_product_mapping, get_item_index, get_product_index
+)
 from dash.exceptions import PreventUpdate
 from dotenv import load_dotenv
 
@@ -625,7 +627,7 @@ def update_table(n_clicks, product_code_val, item_codes_val, unit_operation_val,
         varTraceTarget = None
         
         if item_codes_val:
-            varTraceFor = ", ".join(item_codes_val) if isinstance(item_codes_val, list) else str(item_codes_val)
+            varTraceFor = item_codes_val if isinstance(item_codes_val, list) else [str(item_codes_val)]
             varTraceTarget = None
         
         if gen_trc_val and len(gen_trc_val) > 0:
@@ -912,4 +914,6 @@ def clear_filters(n_clicks):
     return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
 if __name__ == '__main__':
+    get_item_index()  # build the lot/item search index before the first keystroke
+    get_product_index()
     app.run(debug=True, port=8051)
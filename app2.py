@@ -1,14 +1,47 @@
+import os
+import uuid
+
 import dash
+import diskcache
 from dash import dcc, html, Input, Output, callback, State, clientside_callback, dash_table
 from dash_echarts import DashECharts
 import dash_ag_grid as dag
 import pandas as pd
-from Lineage import get_item_codes, get_lineage, get_product_codes, get_item_to_product_mapping
+import polars as pl
+from Lineage import (
+    get_item_codes, get_lineage, get_product_codes, get_item_to_product_mapping, get_item_index, get_product_index,
+    get_item_dimension, slowest_operators, PROGRESS_STAGES, TraceCancelled, TraceTimeout
+)
 from dash.exceptions import PreventUpdate
+from flask import Response, request
+from Metrics import PAYLOAD_BYTES, STAGE_SECONDS, dump, merge, render
+from ResultStore import ResultStore
+from WorkerPoolManager import WorkerPoolManager, cancel_token
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Set LINEAGE_PROFILE=1 to profile every Submit and show the query profile panel
+PROFILE_TRACES = os.getenv("LINEAGE_PROFILE") == "1"
+# Set LINEAGE_TRACE_TIMEOUT to stop a Submit's trace after that many seconds
+TRACE_TIMEOUT = float(os.environ["LINEAGE_TRACE_TIMEOUT"]) if os.getenv("LINEAGE_TRACE_TIMEOUT") else None
+
+# Submit runs as a background callback in a pool of long-lived worker processes, so a long
+# trace does not hold a server worker while the get_lineage result cache, resident ItemMaster
+# and batch graph stay warm between Submits. LINEAGE_TRACE_WORKERS sets the pool size.
+callback_cache = diskcache.Cache(os.getenv("LINEAGE_CALLBACK_CACHE", "./callback_cache"))
+background_callback_manager = WorkerPoolManager(
+    callback_cache, workers=int(os.getenv("LINEAGE_TRACE_WORKERS", "2")), initializer=get_item_dimension
+)
+
+# Submit results stay on the server under a query id, all-data-store only holds the id.
+# 'all' is every mapped row, 'rows' the rows shown in the grid after the product and unit-op filters.
+result_store = ResultStore(os.getenv("LINEAGE_RESULT_STORE", "./result_store"))
+
+# Progress of a Submit: the get_lineage stages, then turning the result into grid rows
+TRACE_STEPS = PROGRESS_STAGES + ("building rows",)
+
+@STAGE_SECONDS.time(stage="csv_to_hierarchy_by_level")
 def csv_to_hierarchy_by_level(csv_data):
     """Create a level-based hierarchy where ProductPN at level N has IngredientPN children,
     and those IngredientPNs become ProductPNs at level N+1"""
@@ -113,7 +146,45 @@ def csv_to_hierarchy_by_level(csv_data):
     
     return build_tree_node(root_node)
 
-app = dash.Dash(__name__)
+def grid_filters(filter_model):
+    """Translate the grid's filterModel into ResultStore filter groups: each column's condition,
+    or its two conditions ORed or ANDed as the user joined them"""
+    filters = []
+    for column, model in (filter_model or {}).items():
+        if 'conditions' in model:
+            conditions = [(column, condition.get('type'), condition.get('filter', '')) for condition in model['conditions']]
+            if model.get('operator') == 'OR':
+                filters.append(conditions)
+            else:
+                filters.extend([condition] for condition in conditions)
+        elif model.get('type') == 'set' or model.get('filterType') == 'set':
+            filters.append([(column, 'in', model.get('values') or [])])
+        else:
+            filters.append([(column, model.get('type'), model.get('filter', ''))])
+    return filters
+
+def grid_sort(sort_model):
+    """Translate the grid's sortModel into ResultStore (column, descending) pairs"""
+    return [(sort['colId'], sort.get('sort') == 'desc') for sort in (sort_model or [])]
+
+app = dash.Dash(__name__, background_callback_manager=background_callback_manager)
+
+@app.server.after_request
+def record_payload_size(response):
+    if request.path.endswith("/_dash-update-component") and response.content_length is not None:
+        body = request.get_json(silent=True) or {}
+        PAYLOAD_BYTES.observe(response.content_length, callback=str(body.get("output", "unknown"))[:200])
+    return response
+
+@app.server.route("/metrics")
+def metrics():
+    # add what background jobs recorded in their own processes since the last scrape
+    while True:
+        _, job_metrics = callback_cache.pull(prefix="metrics")
+        if job_metrics is None:
+            break
+        merge(job_metrics)
+    return Response(render(), mimetype="text/plain; version=0.0.4")
 
 styles = {
     'container': {
@@ -258,7 +329,7 @@ app.layout = html.Div([
     dcc.Download(id="download-all-data"),
     dcc.Download(id="download-filtered-data"),
     dcc.Store(id="all-data-store"),
-    dcc.Store(id="filtered-data-store"),
+    dcc.Store(id="profile-store"),
 
     # Header
     html.Div([
@@ -344,8 +415,13 @@ app.layout = html.Div([
                     )
                 ], style={'marginBottom': '15px'}),
 
-                # Submit & Clear Buttons
+                # Submit & Clear Buttons, with the progress of a running Submit and its Cancel
                 html.Div([
+                    html.Div([
+                        html.Span(id='trace-progress-label', style={'marginRight': '10px', 'fontSize': '13px'}),
+                        html.Progress(id='trace-progress', value='0', max=str(len(TRACE_STEPS))),
+                        html.Button("Cancel", id="cancel-button", style={**styles['clearButton'], 'marginLeft': '10px'})
+                    ], id='trace-progress-panel', style={'display': 'none'}),
                     html.Button("Submit", id="submit-button", style=styles['exportButton']),
                     html.Button("Clear", id="clear-button", style=styles['clearButton'])
                 ], style={'textAlign': 'right'})
@@ -420,12 +496,15 @@ app.layout = html.Div([
                             dag.AgGrid(
                                 id='data-table',
                                 columnDefs=columnDefs,
-                                rowData=[],
+                                rowModelType="infinite",
                                 defaultColDef=defaultColDef,
                                 style={'height': '600px', 'width': '100%'},
                                 dashGridOptions={
                                     "pagination": True,
                                     "paginationPageSize": 20,
+                                    # rows are fetched from the server in blocks, see serve_table_rows
+                                    "cacheBlockSize": 100,
+                                    "maxBlocksInCache": 20,
                                     "suppressExcelExport": False,
                                     "suppressCsvExport": False,
                                 },
@@ -457,7 +536,13 @@ app.layout = html.Div([
             ])
         ], style=styles['section'])
 
-    ], style=styles['container'])
+    ], style=styles['container']),
+
+    # Debug: slowest query operators of the last Submit, only shown when profiling is on
+    html.Details([
+        html.Summary("Query profile"),
+        html.Div(id='profile-panel')
+    ], id='debug-panel', style={'display': 'block' if PROFILE_TRACES else 'none', 'margin': '20px'})
 ])
 
 clientside_callback(
@@ -520,14 +605,13 @@ def update_target_lot_item_options(search_value, value):
     Input('all-data-store', 'data'),
     prevent_initial_call=True
 )
-def update_unit_operation_options(data):
-    if not data:
+def update_unit_operation_options(query_id):
+    frame = result_store.get(query_id, "all")
+    if frame is None or frame.is_empty():
         return []
     
-    df = pd.DataFrame(data)
-    
-    product_codes = set(df['ProductItemCode'].dropna().astype(str))
-    ingredient_codes = set(df['IngredientItemCode'].dropna().astype(str))
+    product_codes = set(frame['ProductItemCode'].drop_nulls().cast(pl.String))
+    ingredient_codes = set(frame['IngredientItemCode'].drop_nulls().cast(pl.String))
     
     all_codes = product_codes.union(ingredient_codes)
     
@@ -548,12 +632,13 @@ def toggle_target_lot_item_dropdown(lookup_value):
     Input('all-data-store', 'data'),
     prevent_initial_call=True
 )
-def update_tree_chart(data):
-    if not data:
+def update_tree_chart(query_id):
+    frame = result_store.get(query_id, "all")
+    if frame is None or frame.is_empty():
         print("No data provided to tree chart")
         return {}
 
-    df = pd.DataFrame(data)
+    df = frame.to_pandas()
     filtered_df = df[
         ~df['ProductPN'].str.upper().str.startswith(('Z', 'B', 'M'), na=False) &
         ~df['IngredientPN'].str.upper().str.startswith(('Z', 'B', 'M'), na=False)
@@ -724,10 +809,10 @@ def update_checklist_based_on_lookup(lookup_value):
 
 @app.callback(
     [
-        Output('data-table', 'rowData'),
         Output('all-data-store', 'data'),
         Output('data-table', 'filterModel'),
-        Output('data-table', 'columnDefs', allow_duplicate=True)
+        Output('data-table', 'columnDefs', allow_duplicate=True),
+        Output('profile-store', 'data')
     ],
     [Input('submit-button', 'n_clicks')],
     [
@@ -737,24 +822,41 @@ def update_checklist_based_on_lookup(lookup_value):
         State('attribute-dropdown', 'value'),
         State('gen-trc-checklist', 'value'),
         State('include-individual-bags-check', 'value'),
-        State('data-table', 'rowData'),
+        State('all-data-store', 'data'),
         State('target-lot-item-dropdown', 'value')
     ],
-    prevent_initial_call=True
+    prevent_initial_call=True,
+    background=True,
+    running=[
+        (Output('submit-button', 'disabled'), True, False),
+        (Output('trace-progress-panel', 'style'), {'display': 'inline-block', 'marginRight': '10px'}, {'display': 'none'}),
+    ],
+    cancel=[Input('cancel-button', 'n_clicks')],
+    progress=[Output('trace-progress', 'value'), Output('trace-progress-label', 'children')],
 )
-def update_table(n_clicks, product_code_val, item_codes_val, unit_operation_val, attribute_val, gen_trc_val, include_individual_bags_val, current_row_data, target_lot_item_val):
+def update_table(set_progress, *args):
+    try:
+        return build_table(set_progress, *args)
+    finally:
+        # leave what this job recorded in its worker process for the server's /metrics
+        callback_cache.push(dump(reset=True), prefix="metrics", expire=3600)
+
+def build_table(set_progress, n_clicks, product_code_val, item_codes_val, unit_operation_val, attribute_val, gen_trc_val, include_individual_bags_val, previous_query_id, target_lot_item_val):
+    def report(step):
+        set_progress((str(TRACE_STEPS.index(step) + 1), f"{step[0].upper()}{step[1:]}..."))
+
     if not n_clicks or not item_codes_val:
-        return [], [], {}, columnDefs
+        return None, {}, columnDefs, None
     
     try:
         varTraceFor = None
         varTraceTarget = None
         
         if item_codes_val:
-            varTraceFor = ", ".join(item_codes_val) if isinstance(item_codes_val, list) else str(item_codes_val)
+            varTraceFor = item_codes_val if isinstance(item_codes_val, list) else [str(item_codes_val)]
         
         if target_lot_item_val:
-            varTraceTarget = ", ".join(target_lot_item_val) if isinstance(target_lot_item_val, list) else str(target_lot_item_val)
+            varTraceTarget = target_lot_item_val if isinstance(target_lot_item_val, list) else [str(target_lot_item_val)]
         
         if gen_trc_val and len(gen_trc_val) > 0:
             if len(gen_trc_val) == 2:
@@ -767,6 +869,7 @@ def update_table(n_clicks, product_code_val, item_codes_val, unit_operation_val,
             GenOrTrc = "all"
         outputType = "polars"
         level = -99
+        request_id = str(uuid.uuid4()) if PROFILE_TRACES else None
         
         # Use product_lot and ingredient_lot if "Include Individual Bags" is checked
         outputcols = """type, root_parentlot, root_itemcode, product_parentlot as startnode, 
@@ -791,13 +894,16 @@ def update_table(n_clicks, product_code_val, item_codes_val, unit_operation_val,
             outputType,
             GenOrTrc,
             level,
-            outputcols=outputcols
+            outputcols=outputcols,
+            engine="link" if varTraceTarget else "sql",
+            profile=request_id,
+            progress=report,
+            timeout=TRACE_TIMEOUT,
+            cancel=cancel_token()
         )
-        
-        print("Database result:", res)
-        print("Columns:", res.columns if hasattr(res, 'columns') else 'No columns attribute')
-        
+
         if res is not None and len(res) > 0:
+            report("building rows")
             if hasattr(res, 'to_pandas'):
                 df_result = res.to_pandas()
                 df_result['Level'] = pd.to_numeric(df_result['Level'], errors='coerce').fillna(0).astype(int)
@@ -812,25 +918,26 @@ def update_table(n_clicks, product_code_val, item_codes_val, unit_operation_val,
             if item_codes:
                 item_to_product = get_item_to_product_mapping(item_codes)
             
-            mapped_data = []
-            for _, row in df_result.iterrows():
-                row_data = {
-                    'ParentItemCode': row.get('root_itemcode', ''),
-                    'ParentName': row.get('ParentDescription', ''),
-                    'ParentPN': row.get('root_parentlot', ''),
-                    'Level': row.get('Level', 0),
-                    'ProductItemCode': row.get('product_itemcode', ''),
-                    'ProductName': row.get('ProductDescription', ''),
-                    'ProductPN': row.get('startnode', ''),
-                    'IngredientItemCode': row.get('ingredient_itemcode', ''),
-                    'IngredientName': row.get('IngredientDescription', ''),
-                    'IngredientPN': row.get('endnode', ''),
-                    'CntRecs': row.get('CntRecs', 0),
-                }
-                row_data['ProductCode'] = item_to_product.get(row_data['ProductItemCode'], None)
-                row_data['IngredientProductCode'] = item_to_product.get(row_data['IngredientItemCode'], None)
-                row_data['RootProductCode'] = item_to_product.get(row_data['ParentItemCode'], None)
-                mapped_data.append(row_data)
+            with STAGE_SECONDS.time(stage="row_mapping"):
+                mapped_data = []
+                for _, row in df_result.iterrows():
+                    row_data = {
+                        'ParentItemCode': row.get('root_itemcode', ''),
+                        'ParentName': row.get('ParentDescription', ''),
+                        'ParentPN': row.get('root_parentlot', ''),
+                        'Level': row.get('Level', 0),
+                        'ProductItemCode': row.get('product_itemcode', ''),
+                        'ProductName': row.get('ProductDescription', ''),
+                        'ProductPN': row.get('startnode', ''),
+                        'IngredientItemCode': row.get('ingredient_itemcode', ''),
+                        'IngredientName': row.get('IngredientDescription', ''),
+                        'IngredientPN': row.get('endnode', ''),
+                        'CntRecs': row.get('CntRecs', 0),
+                    }
+                    row_data['ProductCode'] = item_to_product.get(row_data['ProductItemCode'], None)
+                    row_data['IngredientProductCode'] = item_to_product.get(row_data['IngredientItemCode'], None)
+                    row_data['RootProductCode'] = item_to_product.get(row_data['ParentItemCode'], None)
+                    mapped_data.append(row_data)
             
             filtered_data = mapped_data
             if product_code_val:
@@ -858,71 +965,33 @@ def update_table(n_clicks, product_code_val, item_codes_val, unit_operation_val,
             
             # Update columnDefs with unique values for set filters (simulating Filters... dropdown)
             updated_column_defs = columnDefs.copy()
-            if current_row_data and len(current_row_data) > 0:
+            current_rows = result_store.get(previous_query_id, "rows")
+            if current_rows is not None and not current_rows.is_empty():
                 for col_def in updated_column_defs:
-                    if col_def["filter"] == "agTextColumnFilter":
-                        col_def["filterParams"]["filterOptions"] = ["contains", {"filter": "agSetColumnFilter", "values": sorted(list(set(row[col_def["field"]] for row in current_row_data if row[col_def["field"]])))}]
+                    if col_def["filter"] == "agTextColumnFilter" and col_def["field"] in current_rows.columns:
+                        col_def["filterParams"]["filterOptions"] = ["contains", {"filter": "agSetColumnFilter", "values": sorted(value for value in current_rows[col_def["field"]].unique().to_list() if value)}]
             
-            return filtered_data, mapped_data, {}, updated_column_defs
+            if cancel_token() is not None and cancel_token().is_set():
+                raise TraceCancelled("Submit was cancelled")
+            query_id = result_store.put({
+                "all": pl.DataFrame(mapped_data, infer_schema_length=None),
+                "rows": pl.DataFrame(filtered_data, infer_schema_length=None),
+            })
+            # profiles live in this job's process, so hand the panel its rows rather than the id
+            profile = slowest_operators(request_id, limit=15) if request_id else None
+            return query_id, {}, updated_column_defs, profile
         else:
             print("No data returned from database")
-            return [], [], {}, columnDefs
+            return None, {}, columnDefs, None
             
+    except TraceTimeout as e:
+        print(f"Error getting lineage data: {e}")
+        return None, {}, columnDefs, None
+    except TraceCancelled:
+        raise PreventUpdate  # Cancel keeps the results on screen
     except Exception as e:
         print(f"Error getting lineage data: {e}")
-        return [], [], {}, columnDefs
-
-clientside_callback(
-    """
-    function(filterModel, rowData) {
-        console.log('Filter model changed:', filterModel);
-        console.log('Row data:', rowData);
-
-        if (!rowData || rowData.length === 0) {
-            console.log('No row data available, skipping filter processing');
-            return window.dash_clientside.no_update;
-        }
-
-        if (!filterModel || Object.keys(filterModel).length === 0) {
-            console.log('No filters applied, returning all data');
-            return rowData;
-        }
-
-        let filteredData = rowData.filter(row => {
-            let passesFilter = true;
-
-            for (let column in filterModel) {
-                if (!filterModel.hasOwnProperty(column)) continue;
-
-                const filter = filterModel[column];
-                const rowValue = row[column] != null ? row[column].toString() : '';
-
-                if (filter.type === 'contains') {
-                    const filterValue = filter.filter != null ? filter.filter.toString().toLowerCase() : '';
-                    if (!rowValue.toLowerCase().includes(filterValue)) {
-                        passesFilter = false;
-                        break;
-                    }
-                } else if (filter.type === 'set') {
-                    if (filter.values && filter.values.length > 0 && !filter.values.includes(rowValue)) {
-                        passesFilter = false;
-                        break;
-                    }
-                }
-            }
-
-            return passesFilter;
-        });
-
-        console.log('Filtered data length:', filteredData.length);
-        return filteredData;
-    }
-    """,
-    Output('filtered-data-store', 'data'),
-    [Input('data-table', 'filterModel')],
-    [State('data-table', 'rowData')],
-    prevent_initial_call=True
-)
+        return None, {}, columnDefs, None
 
 clientside_callback(
     """
@@ -984,17 +1053,48 @@ clientside_callback(
     prevent_initial_call=True
 )
 
+@app.callback(
+    Output('data-table', 'getRowsResponse'),
+    Input('data-table', 'getRowsRequest'),
+    State('all-data-store', 'data'),
+    prevent_initial_call=True
+)
+def serve_table_rows(rows_request, query_id):
+    if not rows_request:
+        raise PreventUpdate
+    rows, row_count = result_store.rows(
+        query_id, "rows", rows_request.get('startRow', 0), rows_request.get('endRow', 0),
+        sort=grid_sort(rows_request.get('sortModel')), filters=grid_filters(rows_request.get('filterModel'))
+    )
+    return {"rowData": rows, "rowCount": row_count}
+
+# A new result (or Clear) drops the grid's cached blocks, so it requests its rows again
+clientside_callback(
+    """
+    function(queryId) {
+        const api = dash_ag_grid.getApi('data-table');
+        if (api) {
+            api.purgeInfiniteCache();
+        }
+        return window.dash_clientside.no_update;
+    }
+    """,
+    Output('data-table', 'id'),
+    Input('all-data-store', 'data'),
+    prevent_initial_call=True
+)
+
 @app.callback(
     Output("download-all-data", "data"),
     [Input('export-genealogy-button', 'n_clicks')],
     [State('all-data-store', 'data')],
     prevent_initial_call=True
 )
-def export_all_data(n_clicks, all_data):
-    if n_clicks and all_data:
+def export_all_data(n_clicks, query_id):
+    frame = result_store.get(query_id, "all")
+    if n_clicks and frame is not None and not frame.is_empty():
         try:
-            df = pd.DataFrame(all_data)
-            return dict(content=df.to_csv(index=False), filename="genealogy_all_data.csv")
+            return dict(content=frame.write_csv(), filename="genealogy_all_data.csv")
         except Exception as e:
             print(f"Export error: {e}")
             return dash.no_update
@@ -1003,18 +1103,18 @@ def export_all_data(n_clicks, all_data):
 @app.callback(
     Output("download-filtered-data", "data"),
     [Input('export-filtered-button', 'n_clicks')],
-    [State('filtered-data-store', 'data')],
+    [State('data-table', 'filterModel'), State('all-data-store', 'data')],
     prevent_initial_call=True
 )
-def export_filtered_data(n_clicks, filtered_data):
+def export_filtered_data(n_clicks, filter_model, query_id):
     if not n_clicks:
         return dash.no_update
 
+    filtered_data = result_store.filtered(query_id, "rows", grid_filters(filter_model))
     if filtered_data is not None and len(filtered_data) > 0:
         try:
-            df = pd.DataFrame(filtered_data)
-            print(f"Exporting {len(df)} filtered rows")
-            return dict(content=df.to_csv(index=False), filename="genealogy_filtered_data.csv")
+            print(f"Exporting {len(filtered_data)} filtered rows")
+            return dict(content=filtered_data.write_csv(), filename="genealogy_filtered_data.csv")
         except Exception as e:
             print(f"Filtered export error: {e}")
             return dash.no_update
@@ -1026,9 +1126,7 @@ def export_filtered_data(n_clicks, filtered_data):
     [
         Output('product-codes-dropdown', 'value'),
         Output('item-codes-dropdown', 'value'),
-        Output('data-table', 'rowData', allow_duplicate=True),
         Output('all-data-store', 'data', allow_duplicate=True),
-        Output('filtered-data-store', 'data', allow_duplicate=True),
         Output('unit-operation-dropdown', 'value'),
         Output('attribute-dropdown', 'value'),
         Output('gen-trc-checklist', 'value', allow_duplicate=True),
@@ -1041,8 +1139,30 @@ def export_filtered_data(n_clicks, filtered_data):
 )
 def clear_filters(n_clicks):
     if n_clicks:
-        return None, None, [], [], [], None, None, [], None, [], None
-    return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+        return None, None, None, None, None, [], None, [], None
+    return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+@app.callback(
+    Output('profile-panel', 'children'),
+    Input('profile-store', 'data'),
+    prevent_initial_call=True
+)
+def update_profile_panel(operators):
+    if not operators:
+        raise PreventUpdate
+    return dash_table.DataTable(
+        data=[{**op, 'timing': round(op['timing'] * 1000, 2), 'query': op['query'][:200]} for op in operators],
+        columns=[
+            {'name': 'Stage', 'id': 'stage'},
+            {'name': 'Operator', 'id': 'operator'},
+            {'name': 'Time (ms)', 'id': 'timing'},
+            {'name': 'Rows', 'id': 'rows'},
+            {'name': 'Query', 'id': 'query'},
+        ],
+        style_cell={'textAlign': 'left', 'fontSize': '12px', 'whiteSpace': 'normal'},
+    )
 
 if __name__ == '__main__':
-    app.run(debug=True, port=8051)
+    get_item_index()  # build the lot/item search index before the first keystroke
+    get_product_index()
+    app.run(debug=True, port=8051, threaded=True)
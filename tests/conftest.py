@@ -0,0 +1,30 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def pytest_configure(config):
+    """
+    Build a small synthetic lineage database, with its indexed material transactions table and
+    closure sidecar, and point Lineage at it before any test module imports it.
+    """
+    sys.path.insert(0, ROOT)
+    from SyntheticLineage import generate
+
+    config.lineage_dir = tempfile.mkdtemp(prefix="lineage-tests-")
+    database = os.path.join(config.lineage_dir, "lineage.db")
+    closure = os.path.join(config.lineage_dir, "lineage_closure.db")
+    generate(database, items=80, lots=60, batches=400, depth=6, fan_in=3, fan_out=2, bags=2, reconvergence=0.3)
+    os.environ["LINEAGE_DATABASE_URL"] = database
+    os.environ["LINEAGE_CLOSURE_URL"] = closure
+    for command in (["refresh-mat-txns"], ["build-closure", "--output", closure]):
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, "Lineage.py"), *command, "--database", database],
+            cwd=ROOT, check=True,
+        )
+
+def pytest_unconfigure(config):
+    shutil.rmtree(getattr(config, "lineage_dir", ""), ignore_errors=True)
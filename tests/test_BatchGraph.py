@@ -0,0 +1,86 @@
+import random
+from collections import defaultdict, deque
+
+import duckdb
+import pytest
+
+from BatchGraph import BatchGraph
+from SyntheticLineage import generate
+
+@pytest.fixture(scope="module")
+def graph(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("lineage") / "lineage.db")
+    generate(path, items=60, lots=40, batches=300, depth=6, fan_in=3, fan_out=2, bags=2, reconvergence=0.3)
+    con = duckdb.connect(path, read_only=True)
+    try:
+        yield BatchGraph.load(con)
+    finally:
+        con.close()
+
+def edges(graph, direction):
+    csr = graph.directions[direction]
+    ids = graph.batch_ids.to_list()
+    out = defaultdict(set)
+    for src, dst in zip(csr["src"], csr["dst"]):
+        out[ids[src]].add(ids[dst] if dst >= 0 else None)
+    return out
+
+def distances(out, starts, max_hops):
+    """
+    Plain BFS hop counts from `starts` over the adjacency sets `out`.
+    """
+    dist = {start: 0 for start in starts}
+    queue = deque(starts)
+    while queue:
+        node = queue.popleft()
+        if dist[node] == max_hops:
+            continue
+        for nxt in out.get(node, ()):
+            if nxt is not None and nxt not in dist:
+                dist[nxt] = dist[node] + 1
+                queue.append(nxt)
+    return dist
+
+def expected_links(graph, direction, roots, targets, max_level, first_level, include_target_links):
+    out = edges(graph, direction)
+    back = defaultdict(set)
+    for src, dsts in out.items():
+        for dst in dsts:
+            if dst is not None:
+                back[dst].add(src)
+    max_hops = max_level - first_level + (0 if include_target_links else 1)
+    to_target = distances(back, [t for t in targets if t in graph.batch_ids], max_hops)
+    expected = set()
+    for root in set(roots):
+        if root not in graph.batch_ids:
+            continue
+        for src, pos in distances(out, [root], max_hops).items():
+            for dst in out.get(src, ()):
+                on_path = dst in to_target and pos + 1 + to_target[dst] <= max_hops
+                if on_path or (include_target_links and to_target.get(src) == 0 and pos <= max_hops):
+                    expected.add((root, src, dst, pos + first_level))
+    return expected
+
+def walked_links(graph, direction, walked):
+    src, dst = ("ProductBatchID", "IngredientBatchID") if direction == "Gen" else ("IngredientBatchID", "ProductBatchID")
+    return set(walked.select("RootBatchID", src, dst, "Level").iter_rows())
+
+@pytest.mark.parametrize("direction, first_level, include_target_links", [("Gen", 1, True), ("Trc", 2, False)])
+def test_link_matches_bfs(graph, direction, first_level, include_target_links):
+    rng = random.Random(7)
+    batches = graph.batch_ids.to_list()
+    for _ in range(40):
+        roots = rng.sample(batches, rng.choice([1, 1, 3]))
+        targets = rng.sample(batches, rng.choice([1, 2, 5]))
+        for max_level in (3, 6, 99):
+            walked = graph.link(direction, roots, targets, max_level, first_level, include_target_links)
+            assert walked_links(graph, direction, walked) == expected_links(
+                graph, direction, roots, targets, max_level, first_level, include_target_links
+            )
+
+def test_link_is_walk_towards_targets(graph):
+    batches = graph.batch_ids.to_list()
+    roots = batches[-5:]
+    walked = walked_links(graph, "Gen", graph.walk("Gen", roots, 99, 1))
+    linked = walked_links(graph, "Gen", graph.link("Gen", roots, batches[:50], 99, 1, include_target_links=True))
+    assert linked and linked <= walked
@@ -0,0 +1,67 @@
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+from ItemDimension import ItemDimension
+
+@pytest.fixture
+def items():
+    return pl.DataFrame({
+        "ItemCode": ["I3", "I1", None, "I2", "I1"],
+        "ProductCode": ["P3", "P1", "P0", None, "P1b"],
+        "Description": ["three", "one", "none", "two", "one again"],
+        "tag": ["x", "y", "z", "x", "y"],
+    })
+
+def test_positions_resolve_known_codes_to_their_first_row(items):
+    dimension = ItemDimension(items)
+    assert len(dimension) == 4
+    positions = dimension.positions(["I1", "I4", None, "I3", "I2"])
+    assert positions[1] == -1 and positions[2] == -1
+    assert dimension.lookup(positions, ["Description"])["Description"].to_list() == [
+        "one", None, None, "three", "two"
+    ]
+
+def test_matches_join_like_a_left_join_on_item_code(items):
+    dimension = ItemDimension(items)
+    codes = pl.Series(["I1", "I9", None, "I2", "I1"])
+    rows, pos = dimension.matches(codes)
+    joined = pl.DataFrame({"row": rows}).with_columns(
+        dimension.lookup(pos, ["Description"])["Description"]
+    )
+    expected = (
+        pl.DataFrame({"code": codes}).with_row_index("row")
+        .join(items.select("ItemCode", "Description"), left_on="code", right_on="ItemCode", how="left", maintain_order="left")
+        .select(pl.col("row").cast(pl.Int64), "Description")
+    )
+    assert_frame_equal(joined, expected)
+
+def test_lookup_hands_columns_out_in_itemmaster_types(items):
+    dimension = ItemDimension(items)
+    found = dimension.lookup(dimension.positions(["I3", "I2"]), ["ProductCode", "tag"])
+    assert found.schema == pl.Schema({"ProductCode": pl.String, "tag": pl.String})
+    assert found.rows() == [("P3", "x"), (None, "x")]
+    assert dimension.frame.schema["ProductCode"] == pl.Categorical
+
+def test_product_codes_map_known_item_codes(items):
+    assert ItemDimension(items).product_codes({"I1", "I2", "I4"}) == {"I1": "P1", "I2": None}
+
+def test_enrich_appends_columns_as_chained_left_joins(items):
+    dimension = ItemDimension(items)
+    frame = pl.DataFrame({"product": ["I1", "I2", None, "I9"], "ingredient": ["I3", "I1", "I1", None]})
+    enriched = dimension.enrich(frame, [
+        ("product", [("Description", "product_description"), ("ProductCode", "product_code")]),
+        ("ingredient", [("Description", "ingredient_description")]),
+    ])
+    master = items.filter(pl.col("ItemCode").is_not_null())
+    expected = (
+        frame.join(
+            master.select("ItemCode", pl.col("Description").alias("product_description"), pl.col("ProductCode").alias("product_code")),
+            left_on="product", right_on="ItemCode", how="left", maintain_order="left",
+        )
+        .join(
+            master.select("ItemCode", pl.col("Description").alias("ingredient_description")),
+            left_on="ingredient", right_on="ItemCode", how="left", maintain_order="left",
+        )
+    )
+    assert_frame_equal(enriched, expected)
@@ -0,0 +1,392 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import duckdb
+import polars as pl
+import pytest
+from polars.testing import assert_frame_equal
+
+import Lineage
+from SyntheticLineage import generate
+
+def parent_lots():
+    with Lineage.pool.session() as con:
+        return [lot for (lot,) in con.execute(
+            "select distinct parent_lot_number from MaterialTransactions order by 1"
+        ).fetchall()]
+
+def sorted_rows(frame):
+    return frame.sort(frame.columns, nulls_last=True)
+
+def fresh_lineage(monkeypatch, *args, **kwargs):
+    """
+    get_lineage on a cursor that has never run a trace before.
+    """
+    monkeypatch.setattr(Lineage, "pool", Lineage.CursorPool(Lineage.connection, size=1))
+    return Lineage.get_lineage(*args, use_cache=False, **kwargs)
+
+def test_traces_in_sequence_on_one_cursor_match_fresh_runs(monkeypatch):
+    rng = random.Random(5)
+    lots = parent_lots()
+    shared = Lineage.CursorPool(Lineage.connection, size=1)
+    for _ in range(40):
+        node = [rng.choice(lots)]
+        direction, engine = rng.choice(["all", "gen", "trc"]), rng.choice(["sql", "closure", "csr"])
+        monkeypatch.setattr(Lineage, "pool", shared)
+        reused = Lineage.get_lineage(node, GenOrTrc=direction, engine=engine, use_cache=False)
+        fresh = fresh_lineage(monkeypatch, node, GenOrTrc=direction, engine=engine)
+        assert_frame_equal(sorted_rows(reused), sorted_rows(fresh))
+
+def test_closing_a_stream_releases_its_session(monkeypatch):
+    pool = Lineage.CursorPool(Lineage.connection, size=1)
+    monkeypatch.setattr(Lineage, "pool", pool)
+    node = parent_lots()[:1]
+    expected = Lineage.get_lineage(node, use_cache=False)
+    stream = Lineage.get_lineage(node, outputtype="arrow_stream", use_cache=False)
+    assert not pool._slots.acquire(blocking=False)
+    stream.close()
+    with Lineage.get_lineage(node, outputtype="arrow_stream", use_cache=False) as stream:
+        streamed = pl.from_arrow(stream.read_all())
+    assert_frame_equal(sorted_rows(streamed), sorted_rows(expected))
+    with pool.session(blocking=False) as con:
+        assert con is not None
+
+def test_lazy_result_does_not_hold_a_session(monkeypatch):
+    pool = Lineage.CursorPool(Lineage.connection, size=1)
+    monkeypatch.setattr(Lineage, "pool", pool)
+    node = parent_lots()[:1]
+    expected = Lineage.get_lineage(node, use_cache=False)
+    lazy = Lineage.get_lineage(node, outputtype="lazy", use_cache=False)
+    with pool.session(blocking=False) as con:
+        assert con is not None
+    assert_frame_equal(sorted_rows(lazy.collect()), sorted_rows(expected))
+    assert lazy.head(3).collect().height == min(3, expected.height)
+    assert_frame_equal(
+        sorted_rows(lazy.filter(pl.col("Level") == 1).collect()),
+        sorted_rows(expected.filter(pl.col("Level") == 1)),
+    )
+
+def scanned_tables(profile):
+    pending, scans = [profile], []
+    while pending:
+        node = pending.pop()
+        pending.extend(node.get("children", []))
+        info = node.get("extra_info", {})
+        if "Table" in info:
+            scans.append((info["Table"].rsplit(".", 1)[-1], info.get("Type")))
+    return scans
+
+def test_node_lookups_scan_the_mat_txns_indexes(tmp_path):
+    path = str(tmp_path / "lineage.db")
+    generate(path, items=500, lots=500, batches=5000, depth=6, fan_in=3, fan_out=2, bags=2)
+    Lineage.refresh_mat_txns(path)
+    con = duckdb.connect(path, read_only=True)
+    try:
+        Lineage.create_session_views(con)
+        nodes = con.execute(
+            """
+            select LOT_NUMBER, parent_lot_number, SUPPLIER_LOT_NUMBER, ItemCode
+            from MaterialTransactions where SUPPLIER_LOT_NUMBER is not null limit 1
+            """
+        ).fetchone()
+        con.execute("SET enable_profiling = 'no_output'")
+        Lineage.func_Nodes(con, list(nodes))
+        scans = scanned_tables(json.loads(con.get_profiling_information(format="json")))
+        assert {node for (node,) in con.execute("select distinct node from tmp_NodeMatches").fetchall()} == set(nodes)
+    finally:
+        con.close()
+    assert [kind for table, kind in scans if table == Lineage.MAT_TXNS_TABLE] == ["Index Scan"] * 4
+
+def test_frontier_expands_a_loaded_trace_from_its_last_level():
+    links = ["Level", "product_lot", "ingredient_lot"]
+    for direction, column in (("trc", "product_lot"), ("gen", "ingredient_lot")):
+        for lot in parent_lots()[:10]:
+            loaded = Lineage.get_lineage([lot], GenOrTrc=direction, level=2, use_cache=False)
+            full = Lineage.get_lineage([lot], GenOrTrc=direction, level=4, use_cache=False)
+            assert_frame_equal(
+                sorted_rows(Lineage.get_lineage_frontier([lot], direction, 1, 2)), sorted_rows(loaded)
+            )
+            frontier = loaded.filter(pl.col("Level") == 2)[column].drop_nulls().unique().to_list()
+            if not frontier:
+                continue
+            expanded = [
+                Lineage.get_lineage_frontier(frontier, direction, 3, 4, engine=engine)
+                for engine in ("sql", "closure", "csr")
+            ]
+            assert set(expanded[0]["Level"].to_list()) <= {3, 4}
+            for other in expanded[1:]:
+                assert_frame_equal(sorted_rows(other), sorted_rows(expanded[0]))
+            # every link of the full trace is reached from the frontier, at the same level
+            assert set(full.filter(pl.col("Level") >= 3).select(links).rows()) <= set(expanded[0].select(links).rows())
+            rows = Lineage.get_lineage_frontier(frontier, direction, 3, 4, outputtype="duckdb")
+            assert sorted(rows, key=str) == sorted(expanded[0].rows(), key=str)
+
+def test_profiles_attribute_statements_to_their_stage():
+    Lineage.get_lineage(parent_lots()[:1], use_cache=False, profile="stages")
+    statements = Lineage.get_profile("stages")
+    stages = {statement["stage"] for statement in statements}
+    assert {"func_Nodes", "func_Source", "func_trc_PrBID", "func_gen_PrBID", "final"} <= stages
+    assert stages <= {"func_Nodes", "func_Source", "func_trc_PrBID", "func_gen_PrBID", "get_resident", "final"}
+    for statement in statements:
+        if statement["stage"] == "func_trc_PrBID":
+            assert "Trc" in statement["query"]
+        if statement["stage"] == "func_gen_PrBID":
+            assert "Gen" in statement["query"]
+    assert statements[-1]["stage"] == "final"
+    assert Lineage.current_stage.get() == "final"
+
+def test_concurrent_sessions_keep_their_temp_tables_apart():
+    pool = Lineage.CursorPool(Lineage.connection, size=2)
+    barrier = threading.Barrier(2)
+    seen = {}
+
+    def session(name):
+        with pool.session() as con:
+            con.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_Isolation (name VARCHAR)")
+            con.execute("INSERT INTO tmp_Isolation VALUES (?)", [name])
+            barrier.wait()  # both sessions hold their rows at once
+            seen[name] = [row for (row,) in con.execute("select name from tmp_Isolation").fetchall()]
+            barrier.wait()
+
+    threads = [threading.Thread(target=session, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == {"a": ["a"], "b": ["b"]}
+    with pool.session() as con:
+        assert con.execute("select count(*) from tmp_Isolation").fetchone()[0] == 0
+
+def test_concurrent_traces_match_sequential_ones(monkeypatch):
+    monkeypatch.setattr(Lineage, "pool", Lineage.CursorPool(Lineage.connection, size=3))
+    lots = parent_lots()[:12]
+    expected = {lot: sorted_rows(Lineage.get_lineage([lot], use_cache=False)) for lot in lots}
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = dict(zip(lots, executor.map(lambda lot: Lineage.get_lineage([lot], use_cache=False), lots)))
+    for lot in lots:
+        assert_frame_equal(sorted_rows(results[lot]), expected[lot])
+
+def test_start_nodes_are_bound_as_one_list_parameter():
+    lots = parent_lots()[:3]
+    expected = sorted_rows(Lineage.get_lineage(lots, use_cache=False))
+    shuffled = [lots[2], lots[0], lots[1], lots[0], "no such lot", "L'); DROP TABLE ItemMaster; --"]
+    assert_frame_equal(sorted_rows(Lineage.get_lineage(shuffled, use_cache=False)), expected)
+    assert_frame_equal(
+        sorted_rows(Lineage.get_lineage(lots[0], use_cache=False)),
+        sorted_rows(Lineage.get_lineage([lots[0]], use_cache=False)),
+    )
+    with Lineage.pool.session() as con:
+        Lineage.bind_nodes(con, "tmp_Nodes", shuffled, "Source")
+        assert con.execute("select node, role from tmp_Nodes order by node").fetchall() == [
+            (node, "Source") for node in sorted(set(shuffled))
+        ]
+        assert con.execute("select count(*) from ItemMaster").fetchone()[0] > 0
+
+def test_result_cache_keeps_entries_of_one_version_within_its_bytes():
+    frame = pl.DataFrame({"lot": ["L1", "L2"]})
+    cache = Lineage.ResultCache(max_bytes=2 * frame.estimated_size())
+    for key in ("a", "b", "c"):
+        cache.put(key, 1, frame)
+    assert cache.get("a", 1) is None  # least recently used, evicted for 'c'
+    assert cache.get("b", 1) is frame and cache.get("c", 1) is frame
+    cache.put(("too", "big"), 1, pl.concat([frame] * 3))
+    assert cache.get(("too", "big"), 1) is None
+    assert cache.get("b", 2) is None  # a new database version drops every entry
+    assert cache.get("c", 1) is None
+    info = cache.info()
+    assert (info["evictions"], info["invalidations"], info["entries"], info["bytes"]) == (1, 1, 0, 0)
+
+def test_lineage_cache_is_keyed_on_normalized_nodes_and_the_database_version(monkeypatch):
+    monkeypatch.setattr(Lineage, "result_cache", Lineage.ResultCache())
+    monkeypatch.setattr(Lineage, "database_version", lambda *paths: "v1")
+    lots = parent_lots()[:2]
+    first = Lineage.get_lineage(lots)
+    assert Lineage.get_lineage([lots[1], lots[0], lots[1]]) is first
+    assert Lineage.get_lineage(lots, GenOrTrc="trc") is not first
+    assert Lineage.cache_info()["hits"] == 1
+    monkeypatch.setattr(Lineage, "database_version", lambda *paths: "v2")
+    again = Lineage.get_lineage(lots)
+    assert again is not first
+    assert_frame_equal(sorted_rows(again), sorted_rows(first))
+    assert Lineage.cache_info()["invalidations"] == 1
+
+def test_engines_return_the_same_lineage():
+    for lot in random.Random(4).sample(parent_lots(), 12):
+        for direction in ("gen", "trc", "all"):
+            for level in (-99, 2):
+                results = [
+                    sorted_rows(Lineage.get_lineage([lot], GenOrTrc=direction, level=level, engine=engine, use_cache=False))
+                    for engine in ("sql", "closure", "csr")
+                ]
+                assert_frame_equal(results[1], results[0])
+                assert_frame_equal(results[2], results[0])
+
+def test_many_start_sets_attribute_rows_to_their_own_set():
+    lots = random.Random(11).sample(parent_lots(), 6)
+    sets = {"first": lots[:2], "second": lots[1:4], "third": lots[4:]}
+    result = Lineage.get_lineage_many(sets, use_cache=False)
+    assert set(result["query_root"].unique()) <= set(sets)
+    for root, nodes in sets.items():
+        rows = result.filter(pl.col("query_root") == root).drop("query_root")
+        assert_frame_equal(sorted_rows(rows), sorted_rows(Lineage.get_lineage(nodes, use_cache=False)))
+    by_position = Lineage.get_lineage_many([lots[:2]], GenOrTrc="trc", use_cache=False)
+    assert by_position["query_root"].unique().to_list() == ["0"]
+
+def test_product_codes_are_served_from_the_catalog():
+    with Lineage.pool.session() as con:
+        codes = [code for (code,) in con.execute(
+            "select distinct ProductCode from ItemMaster where ProductCode is not null order by lower(ProductCode)"
+        ).fetchall()]
+    assert [option["value"] for option in Lineage.get_product_codes()] == codes
+    term = codes[len(codes) // 2][1:3]
+    found = [option["value"] for option in Lineage.get_product_codes(term.upper())]
+    assert sorted(found) == sorted(code for code in codes if term.lower() in code.lower())
+    assert all(option["label"] == option["value"] for option in Lineage.get_product_codes(term))
+
+def test_item_to_product_mapping_matches_itemmaster():
+    with Lineage.pool.session() as con:
+        expected = dict(con.execute(
+            "select ItemCode, first(ProductCode order by rowid) from ItemMaster where ItemCode is not null group by ItemCode"
+        ).fetchall())
+    codes = set(list(expected)[:20]) | {"not an item"}
+    assert Lineage.get_item_to_product_mapping(codes) == {code: expected[code] for code in codes if code in expected}
+    assert Lineage.get_item_to_product_mapping(set()) == {}
+
+def test_late_enrichment_matches_grouping_the_enriched_rows():
+    lots = random.Random(16).sample(parent_lots(), 4)
+    outputcols = """type, level, product_itemcode, product_description as ProductDescription,
+        ingredient_unit_op_name, COUNT(*) as CntRecs"""
+    assert Lineage.late_enriched_query("select 1", outputcols) is not None
+    grouped = Lineage.get_lineage(lots, outputcols=outputcols, use_cache=False)
+    full = Lineage.get_lineage(lots, use_cache=False)
+    expected = full.group_by(
+        "type", "Level", "product_itemcode", "product_description", "ingredient_unit_op_name"
+    ).agg(pl.len().cast(pl.Int64).alias("CntRecs"))
+    assert grouped.columns == ["type", "Level", "product_itemcode", "ProductDescription", "ingredient_unit_op_name", "CntRecs"]
+    assert sorted(grouped.rows(), key=str) == sorted(expected.rows(), key=str)
+
+def test_targeted_traces_keep_only_the_rows_reaching_a_target():
+    rng = random.Random(17)
+    checked = 0
+    for lot in rng.sample(parent_lots(), 10):
+        full = Lineage.get_lineage([lot], use_cache=False)
+        lots = full["product_lot"].drop_nulls().unique().sort().to_list()
+        lots += full["ingredient_lot"].drop_nulls().unique().sort().to_list()
+        if not lots:
+            continue
+        targets = rng.sample(lots, min(3, len(lots)))
+        with Lineage.pool.session() as con:
+            consumed = {target for (target,) in con.execute(
+                "select distinct LOT_NUMBER from mat_txns where TYPE = 'Ingredient' and list_contains(?, LOT_NUMBER)",
+                [targets],
+            ).fetchall()}
+        targeted = Lineage.get_lineage([lot], targets, use_cache=False)
+        expected = full.filter(
+            pl.when(pl.col("type") == "Trc").then(pl.col("product_lot")).otherwise(pl.col("ingredient_lot")).is_in(consumed)
+        )
+        assert_frame_equal(sorted_rows(targeted), sorted_rows(expected))
+        checked += targeted.height > 0
+    assert checked
+
+def test_profiled_requests_are_listed_newest_first_with_their_slowest_operators():
+    lot = parent_lots()[:1]
+    expected = Lineage.get_lineage(lot, use_cache=False)
+    assert_frame_equal(sorted_rows(Lineage.get_lineage(lot, profile="older")), sorted_rows(expected))
+    rows = Lineage.get_lineage(lot, outputtype="duckdb", profile="newer")
+    assert sorted(rows, key=str) == sorted(expected.rows(), key=str)
+    assert Lineage.list_profiles()[:2] == ["newer", "older"]
+    operators = Lineage.slowest_operators("newer", limit=5)
+    assert 0 < len(operators) <= 5
+    assert [op["timing"] for op in operators] == sorted((op["timing"] for op in operators), reverse=True)
+    assert {op["stage"] for op in operators} <= {s["stage"] for s in Lineage.get_profile("newer")}
+    assert Lineage.get_profile("unknown") == [] and Lineage.slowest_operators("unknown") == []
+
+def test_all_traces_gen_on_a_free_second_cursor(monkeypatch):
+    lots = random.Random(21).sample(parent_lots(), 5)
+    expected = sorted_rows(pl.concat([
+        Lineage.get_lineage(lots, GenOrTrc="gen", use_cache=False),
+        Lineage.get_lineage(lots, GenOrTrc="trc", use_cache=False),
+    ]))
+    for size in (2, 1):
+        pool = Lineage.CursorPool(Lineage.connection, size=size)
+        monkeypatch.setattr(Lineage, "pool", pool)
+        stages = []
+        for engine in ("sql", "csr"):
+            result = Lineage.get_lineage(lots, engine=engine, use_cache=False, progress=stages.append)
+            assert_frame_equal(sorted_rows(result), expected)
+        assert {"tracing Trc", "tracing Gen"} <= set(stages)
+        for _ in range(size):  # the helper cursor went back to the pool
+            assert pool._slots.acquire(blocking=False)
+
+def test_cancelled_and_late_traces_stop_and_free_their_session(monkeypatch):
+    pool = Lineage.CursorPool(Lineage.connection, size=1)
+    monkeypatch.setattr(Lineage, "pool", pool)
+    lot = parent_lots()[:1]
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(Lineage.TraceCancelled):
+        Lineage.get_lineage(lot, use_cache=False, cancel=cancel)
+
+    cancel = threading.Event()
+    def cancel_on_trace(stage):
+        if stage == "tracing Trc":
+            cancel.set()
+    with pytest.raises(Lineage.TraceCancelled) as raised:
+        Lineage.get_lineage(lot, use_cache=False, cancel=cancel, progress=cancel_on_trace)
+    assert not isinstance(raised.value, Lineage.TraceTimeout)
+
+    with pytest.raises(Lineage.TraceTimeout):
+        Lineage.get_lineage(lot, use_cache=False, timeout=0.2, progress=lambda stage: time.sleep(0.3))
+
+    with pool.session():  # every session is taken, so the wait for one times out
+        started = time.monotonic()
+        with pytest.raises(Lineage.TraceTimeout):
+            Lineage.get_lineage(lot, use_cache=False, timeout=0.2)
+        assert time.monotonic() - started < 2
+
+    assert_frame_equal(
+        sorted_rows(Lineage.get_lineage(lot, use_cache=False, timeout=30, cancel=threading.Event())),
+        sorted_rows(Lineage.get_lineage(lot, use_cache=False)),
+    )
+    assert pool._slots.acquire(blocking=False)
+
+def test_trace_guard_interrupts_a_running_statement():
+    cancel = threading.Event()
+    threading.Timer(0.2, cancel.set).start()
+    con = Lineage.connection.cursor()
+    try:
+        started = time.monotonic()
+        with pytest.raises(Lineage.TraceCancelled):
+            with Lineage.TraceGuard(timeout=30, cancel=cancel) as guard:
+                guard.wrap(con).execute("select count(*) from range(1000000000000) a").fetchall()
+        assert time.monotonic() - started < 5
+        assert con.execute("select 42").fetchone() == (42,)
+    finally:
+        con.close()
+
+def test_start_and_target_nodes_resolve_in_one_pass():
+    with Lineage.pool.session() as con:
+        lot, parent, supplier, item = con.execute(
+            """
+            select LOT_NUMBER, parent_lot_number, SUPPLIER_LOT_NUMBER, ItemCode
+            from mat_txns where SUPPLIER_LOT_NUMBER is not null order by LOT_NUMBER limit 1
+            """
+        ).fetchone()
+        Lineage.func_Nodes(con, [lot, supplier, "no such node"], [parent, item, lot])
+        matches = con.execute("select nodetype, node, role, TYPE, LOT_NUMBER from tmp_NodeMatches").pl()
+        for nodetype, node, column in (
+            ("Lot", lot, "LOT_NUMBER"), ("ParentLot", parent, "parent_lot_number"),
+            ("SupplierLot", supplier, "SUPPLIER_LOT_NUMBER"), ("Item", item, "ItemCode"),
+        ):
+            expected = con.execute(
+                f"select distinct TYPE, LOT_NUMBER from mat_txns where {column} = ?", [node]
+            ).fetchall()
+            found = matches.filter((pl.col("nodetype") == nodetype) & (pl.col("node") == node))
+            assert sorted(found.select("TYPE", "LOT_NUMBER").unique().rows()) == sorted(expected)
+    roles = dict(matches.group_by("node").agg(pl.col("role").unique().sort()).rows())
+    assert roles[lot] == ["Source", "Target"]
+    assert roles[supplier] == ["Source"] and roles[parent] == ["Target"] and roles[item] == ["Target"]
+    assert "no such node" not in roles
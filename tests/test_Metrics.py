@@ -0,0 +1,56 @@
+import pytest
+
+import Metrics
+from Metrics import Counter, Gauge, Histogram
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """
+    An empty metrics registry for each test, so the process-wide metrics are left alone.
+    """
+    monkeypatch.setattr(Metrics, "registry", [])
+
+def test_render_writes_the_prometheus_text_format():
+    requests = Counter("test_requests_total", "Requests, by engine.")
+    requests.inc(engine="sql")
+    requests.inc(2, engine="csr")
+    in_flight = Gauge("test_in_flight", "Requests running.")
+    with in_flight.track():
+        in_flight.inc()
+    assert Metrics.render() == (
+        "# HELP test_requests_total Requests, by engine.\n"
+        "# TYPE test_requests_total counter\n"
+        'test_requests_total{engine="sql"} 1\n'
+        'test_requests_total{engine="csr"} 2\n'
+        "# HELP test_in_flight Requests running.\n"
+        "# TYPE test_in_flight gauge\n"
+        "test_in_flight 1\n"
+    )
+
+def test_histograms_render_cumulative_buckets_sum_and_count():
+    seconds = Histogram("test_seconds", "Seconds per stage.", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        seconds.observe(value, stage="trc")
+    assert Metrics.render().splitlines()[2:] == [
+        'test_seconds_bucket{stage="trc",le="0.1"} 2',
+        'test_seconds_bucket{stage="trc",le="1"} 3',
+        'test_seconds_bucket{stage="trc",le="+Inf"} 4',
+        'test_seconds_sum{stage="trc"} 3.65',
+        'test_seconds_count{stage="trc"} 4',
+    ]
+
+def test_label_values_are_escaped():
+    Counter("test_escaped_total", "Escaped labels.").inc(path='a"b\\c\nd')
+    assert Metrics.render().splitlines()[-1] == 'test_escaped_total{path="a\\"b\\\\c\\nd"} 1'
+
+def test_dumps_from_another_process_merge_into_the_metrics():
+    requests = Counter("test_requests_total", "Requests, by engine.")
+    seconds = Histogram("test_seconds", "Seconds per stage.", buckets=(1,))
+    requests.inc(engine="sql")
+    seconds.observe(0.5, stage="gen")
+    dump = Metrics.dump(reset=True)
+    assert requests.values() == [] and seconds.values() == []
+    Metrics.merge(dump)
+    Metrics.merge(dump | {"test_unknown": [((), 1)]})
+    assert requests.values() == [((("engine", "sql"),), 2)]
+    assert seconds.values() == [((("stage", "gen"),), ([2, 0], 1.0))]
@@ -0,0 +1,83 @@
+import os
+import time
+
+import polars as pl
+import pytest
+
+from ResultStore import ResultStore
+
+@pytest.fixture
+def store(tmp_path):
+    return ResultStore(str(tmp_path / "results"))
+
+def age(store, query_id, seconds):
+    then = time.time() - seconds
+    os.utime(os.path.join(store.directory, query_id), (then, then))
+
+def test_get_reads_through_from_disk(tmp_path):
+    frame = pl.DataFrame({"lot": ["L1", "L2"], "level": [1, 2]})
+    query_id = ResultStore(str(tmp_path)).put({"all": frame})
+    other = ResultStore(str(tmp_path))  # another process, with an empty LRU
+    assert other.get(query_id, "all").equals(frame)
+    assert other.get(query_id, "missing") is None
+    assert other.get("not-an-id", "all") is None
+
+def test_pruned_results_are_not_served_from_memory(store):
+    old = store.put({"all": pl.DataFrame({"lot": ["L1"]})})
+    age(store, old, store.max_age + 60)
+    new = store.put({"all": pl.DataFrame({"lot": ["L2"]})})
+    assert store.get(old, "all") is None
+    assert store.rows(old, "all", 0, 10) == ([], 0)
+    assert store.get(new, "all")["lot"].to_list() == ["L2"]
+    assert [key for key in store._entries] == [(new, "all")]
+
+def test_results_pruned_by_another_process_are_forgotten(tmp_path):
+    server, job = ResultStore(str(tmp_path)), ResultStore(str(tmp_path))
+    old = server.put({"all": pl.DataFrame({"lot": ["L1"]})})
+    assert server.get(old, "all") is not None
+    age(job, old, job.max_age + 60)
+    job.prune()
+    assert server.get(old, "all") is None
+    assert server._bytes == 0
+
+@pytest.fixture
+def lots(store):
+    frame = pl.DataFrame({
+        "lot": [f"L{i:03d}" for i in range(50)],
+        "level": [i % 4 for i in range(50)],
+        "item": ["Alpha" if i % 3 else None for i in range(50)],
+    })
+    return frame, store.put({"all": frame})
+
+def test_pages_follow_the_sort_and_never_overlap(store, lots):
+    frame, query_id = lots
+    pages = [store.rows(query_id, "all", start, start + 7, sort=[("level", True)]) for start in range(0, 50, 7)]
+    assert {total for _, total in pages} == {50}
+    rows = [row for page, _ in pages for row in page]
+    expected = frame.with_row_index("order").sort(["level", "order"], descending=[True, False]).drop("order")
+    assert rows == expected.to_dicts()
+    assert store.rows(query_id, "all", 0, 3, sort=[("missing", False)])[0] == frame.head(3).to_dicts()
+
+def test_filters_match_any_condition_of_every_group(store, lots):
+    frame, query_id = lots
+    filters = [
+        [("level", "equals", "1"), ("level", "equals", "3")],
+        [("lot", "contains", "l01"), ("lot", "endsWith", "9")],
+        [("item", "notEqual", "beta")],
+    ]
+    page, total = store.rows(query_id, "all", 0, 100, filters=filters)
+    expected = frame.filter(
+        pl.col("level").is_in([1, 3])
+        & (pl.col("lot").str.contains("L01") | pl.col("lot").str.ends_with("9"))
+    )
+    assert total == expected.height and page == expected.to_dicts()
+    assert store.filtered(query_id, "all", filters).equals(expected)
+
+def test_in_filters_match_exact_values_including_blanks(store, lots):
+    frame, query_id = lots
+    filters = [[("item", "in", ["", "alpha"])], [("lot", "startsWith", "L00"), ("unknown", "equals", "x")]]
+    page, total = store.rows(query_id, "all", 0, 100, filters=filters)
+    assert [row["lot"] for row in page] == ["L000", "L003", "L006", "L009"]
+    assert total == 4
+    assert store.rows(query_id, "all", 2, 100, filters=filters) == (page[2:], 4)
+    assert store.filtered(query_id, "missing") is None
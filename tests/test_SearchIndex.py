@@ -0,0 +1,52 @@
+import random
+
+import polars as pl
+import pytest
+
+from SearchIndex import SearchIndex
+
+def ranked(codes, term, limit):
+    """
+    The codes containing `term` in SearchIndex order: exact match, prefix matches, then other
+    substring matches, each group in lowercased key order.
+    """
+    term = term.strip().lower()
+    keys = sorted(codes, key=str.lower)
+    exact = [code for code in keys if code.lower() == term]
+    prefix = [code for code in keys if code.lower().startswith(term) and code.lower() != term]
+    inner = [code for code in keys if term in code.lower() and not code.lower().startswith(term)]
+    return (exact + prefix + inner)[:limit]
+
+@pytest.fixture(scope="module")
+def codes():
+    rng = random.Random(13)
+    alphabet = "ABCab-01"
+    codes = {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 8))) for _ in range(3000)}
+    return sorted(codes | {"AB", "ab-1", "Ab-10", "xAB"})
+
+@pytest.fixture(scope="module")
+def index(codes):
+    series = pl.Series(codes)
+    return SearchIndex(series, "label " + series)
+
+def test_search_ranks_exact_then_prefix_then_substring(index, codes):
+    rng = random.Random(5)
+    terms = ["ab", "AB", " ab-1 ", "b-1", "a", "-", "0", "zz", "ab-10"] + [rng.choice(codes)[1:4] for _ in range(40)]
+    for term in terms:
+        for limit in (1, 7, 100, None):
+            found = [index.values[i] for i in index.search(term, limit)]
+            assert found == ranked(codes, term, len(codes) if limit is None else limit), (term, limit)
+
+def test_empty_term_lists_codes_in_key_order(index, codes):
+    assert [option["value"] for option in index.options("", 5)] == sorted(codes, key=str.lower)[:5]
+    assert len(index.search(None, None)) == len(codes)
+
+def test_options_carry_the_label_of_each_code(index):
+    assert index.options("ab-10", 1) == [{"label": "label Ab-10", "value": "Ab-10"}]
+    assert index.options("no such code") == []
+
+def test_from_frame_drops_null_and_repeated_codes():
+    frame = pl.DataFrame({"value": ["P1", None, "P1", "P2"], "label": ["one", "none", "one", "two"]})
+    index = SearchIndex.from_frame(frame)
+    assert len(index) == 2
+    assert [option["value"] for option in index.options("p")] == ["P1", "P2"]
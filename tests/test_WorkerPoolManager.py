@@ -0,0 +1,69 @@
+import os
+import time
+
+import diskcache
+import pytest
+
+from WorkerPoolManager import WorkerPoolManager, cancel_token
+
+def record_pid(key, progress_key, args, context):
+    """
+    A job storing its arguments and the worker's pid under the result key.
+    """
+    diskcache.Cache(args["cache"]).set(key, (args["value"], os.getpid()))
+
+def wait_for_cancel(key, progress_key, args, context):
+    cache = diskcache.Cache(args["cache"])
+    cache.set(progress_key, "started")
+    while not cancel_token().is_set():
+        time.sleep(0.05)
+    cache.set(key, "cancelled")
+
+def ignore_cancel(key, progress_key, args, context):
+    diskcache.Cache(args["cache"]).set(progress_key, "started")
+    time.sleep(600)
+
+def wait_until(condition, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+@pytest.fixture
+def manager(tmp_path):
+    cache = diskcache.Cache(str(tmp_path / "cache"))
+    manager = WorkerPoolManager(cache, workers=1, grace=0.5)
+    yield manager
+    for process in manager._processes:
+        process.kill()
+        process.join(5)
+    cache.close()
+
+def test_jobs_run_one_after_another_in_the_same_worker(manager):
+    cache = manager.handle.directory
+    first = manager.call_job_fn("first", record_pid, {"cache": cache, "value": 1}, None)
+    second = manager.call_job_fn("second", record_pid, {"cache": cache, "value": 2}, None)
+    wait_until(lambda: not manager.job_running(first) and not manager.job_running(second))
+    (one, pid), (two, other) = manager.handle.get("first"), manager.handle.get("second")
+    assert (one, two) == (1, 2)
+    assert pid == other == manager._processes[0].pid != os.getpid()
+
+def test_cancelled_jobs_see_their_cancel_token(manager):
+    job = manager.call_job_fn("result", wait_for_cancel, {"cache": manager.handle.directory}, None)
+    wait_until(lambda: manager.handle.get("result-progress") == "started")
+    assert manager.job_running(job)
+    manager.terminate_job(job)
+    wait_until(lambda: not manager.job_running(job))
+    assert manager.handle.get("result") == "cancelled"
+
+def test_jobs_ignoring_cancellation_lose_their_worker(manager):
+    cache = manager.handle.directory
+    job = manager.call_job_fn("stuck", ignore_cancel, {"cache": cache}, None)
+    wait_until(lambda: manager.handle.get("stuck-progress") == "started")
+    stuck_pid = manager._processes[0].pid
+    manager.terminate_job(job)
+    wait_until(lambda: not manager.job_running(job))
+    after = manager.call_job_fn("after", record_pid, {"cache": cache, "value": 3}, None)
+    wait_until(lambda: not manager.job_running(after))
+    value, pid = manager.handle.get("after")
+    assert value == 3 and pid != stuck_pid